@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class ExternalAuthConfig(AppConfig):
+    name = "saleor_external_auth_plugin"
+    verbose_name = "External authentication"
+    default_auto_field = "django.db.models.BigAutoField"
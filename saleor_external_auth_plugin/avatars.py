@@ -0,0 +1,275 @@
+import hashlib
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from tempfile import SpooledTemporaryFile
+from typing import IO, Iterator, List, Optional
+
+import requests
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+
+from saleor.account.error_codes import AccountErrorCode
+from saleor.account.models import User
+from saleor.graphql.core.utils import validate_image_file
+
+from . import constants, http_client
+from .conf import get_setting
+from .external_auth_types import ExternalAuthError, InvalidAvatarError
+
+# Bounds the concurrent downloads of a worker process (threads/gevent pools)
+_download_slots = threading.BoundedSemaphore(constants.AVATAR_SYNC_CONCURRENCY)
+# Bytes needed to tell the image type
+SNIFF_SIZE = 12
+
+
+def get_avatar_source(user: User) -> dict:
+    """Where the user's avatar came from: url, etag, last_modified,
+    content hash and when it was last checked"""
+    return user.get_value_from_private_metadata(constants.AVATAR_METADATA_KEY, {})
+
+
+def set_avatar_source(user: User, source: dict) -> User:
+    user.store_value_in_private_metadata({constants.AVATAR_METADATA_KEY: source})
+    return user
+
+
+def save_avatar(user: User, update_fields: List[str]) -> None:
+    """Save the user's 'update_fields' and avatar source. The source is
+    merged into the private metadata stored now, which other writers may
+    have changed since the user was read"""
+
+    source = get_avatar_source(user)
+    with transaction.atomic():
+        stored = (
+            User.objects.select_for_update().only("private_metadata").get(pk=user.pk)
+        )
+        user.private_metadata = stored.private_metadata
+        set_avatar_source(user, source)
+        user.save(update_fields=[*update_fields, "private_metadata"])
+
+
+def needs_refresh(user: User, refresh_interval: Optional[int]) -> bool:
+    """Users without avatar need one unless 'user.avatar_uri' was rejected,
+    the others (and rejected urls) only if 'refresh_interval' (seconds)
+    passed since the last check"""
+
+    source = get_avatar_source(user)
+    rejected = source.get("rejected") and source.get("url") == user.avatar_uri
+    if not user.avatar and not rejected:
+        return True
+    if refresh_interval is None:
+        return False
+    return time.time() - source.get("checked_at", 0) >= refresh_interval
+
+
+def update_avatar(user: User) -> bool:
+    """Download the image at 'user.avatar_uri' and set it as the user's avatar.
+    The download is conditional to the stored source's etag and last_modified.
+    Returns if the avatar changed, the source is updated either way"""
+
+    source = get_avatar_source(user)
+    headers = {}
+    if user.avatar and source.get("url") == user.avatar_uri:
+        if source.get("etag"):
+            headers["If-None-Match"] = source["etag"]
+        if source.get("last_modified"):
+            headers["If-Modified-Since"] = source["last_modified"]
+
+    try:
+        with _download_slots:
+            response = http_client.request(
+                "GET", None, user.avatar_uri, headers=headers, stream=True
+            )
+            try:
+                response.raise_for_status()
+                checked = {"url": user.avatar_uri, "checked_at": time.time()}
+                if response.status_code == 304:
+                    source.pop("rejected", None)
+                    set_avatar_source(user, {**source, **checked})
+                    return False
+                try:
+                    with download(response, user.avatar_uri) as image:
+                        content_hash = image.sha256
+                        unchanged = user.avatar and content_hash == source.get("hash")
+                        if not unchanged:
+                            set_avatar(user, image)
+                except InvalidAvatarError as e:
+                    # not downloaded again until the url changes or is refreshed
+                    set_avatar_source(user, {**source, **checked, "rejected": e.reason})
+                    raise
+            finally:
+                response.close()
+    except requests.exceptions.RequestException:
+        raise ExternalAuthError(
+            f"Could not download avatar from {user.avatar_uri}", "avatar_unavailable"
+        )
+
+    set_avatar_source(
+        user,
+        {
+            **checked,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "hash": content_hash,
+        },
+    )
+    return not unchanged
+
+
+def sniff_content_type(head: bytes) -> Optional[str]:
+    """Image type of the file starting with 'head', None if not accepted"""
+
+    for content_type, signature in constants.AVATAR_SIGNATURES.items():
+        if re.match(signature, head, re.DOTALL):
+            return content_type
+    return None
+
+
+@dataclass
+class Download:
+    file: IO[bytes]
+    content_type: str
+    size: int
+    sha256: str
+
+
+@contextmanager
+def download(response: requests.Response, uri: str) -> Iterator[Download]:
+    """Stream the body of 'response' to a spooled temporary file, available
+    until the block exits. Bodies that aren't an accepted image or are bigger
+    than AVATAR_MAX_SIZE are rejected as soon as that's known, before
+    reading the rest"""
+
+    max_size = get_setting("AVATAR_MAX_SIZE")
+    declared_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+    if declared_type not in constants.AVATAR_SIGNATURES:
+        raise InvalidAvatarError(uri, f"content type {declared_type or 'missing'}")
+    try:
+        declared_size = int(response.headers.get("Content-Length") or 0)
+    except ValueError:
+        raise InvalidAvatarError(uri, "invalid content length")
+    if declared_size > max_size:
+        raise InvalidAvatarError(uri, "too big")
+
+    digest = hashlib.sha256()
+    head, size, content_type = b"", 0, None
+    with SpooledTemporaryFile(max_size=constants.AVATAR_SPOOL_SIZE) as file:
+        for chunk in response.iter_content(constants.AVATAR_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise InvalidAvatarError(uri, "too big")
+            if content_type is None:
+                head += chunk
+                if len(head) >= SNIFF_SIZE:
+                    content_type = sniff_content_type(head)
+                    if content_type is None:
+                        raise InvalidAvatarError(uri, "not an image")
+            digest.update(chunk)
+            file.write(chunk)
+
+        content_type = content_type or sniff_content_type(head)
+        if content_type is None:
+            raise InvalidAvatarError(uri, "not an image")
+        file.seek(0)
+        yield Download(file, content_type, size, digest.hexdigest())
+
+
+def avatar_name(image: Download) -> str:
+    """Storage name of an avatar, the same for identical images"""
+
+    name = f"{image.sha256}.{image.content_type.split('/')[1]}"
+    return User._meta.get_field("avatar").generate_filename(None, name)
+
+
+def release_avatar(user: User) -> None:
+    """Unset the user's avatar and thumbnails. Their files are deleted
+    AVATAR_DELETE_DELAY seconds later if no one references them by then:
+    another user may be about to share them, checked and saved apart"""
+
+    from saleor.thumbnail.models import Thumbnail
+
+    from .tasks import delete_unused_avatar_task
+
+    thumbnails = Thumbnail.objects.filter(user=user)
+    thumbnail_names = [thumbnail.image.name for thumbnail in thumbnails]
+    thumbnails.delete()
+    if user.avatar or thumbnail_names:
+        delete_unused_avatar_task.apply_async(
+            kwargs={"name": user.avatar.name or None, "thumbnails": thumbnail_names},
+            countdown=constants.AVATAR_DELETE_DELAY,
+        )
+    user.avatar = None
+
+
+def delete_unused_avatar(name: Optional[str], thumbnails: List[str]) -> None:
+    """Delete the avatar file 'name' and the 'thumbnails' files that
+    no user avatar nor thumbnail references"""
+
+    from saleor.thumbnail.models import Thumbnail
+
+    if name and not User.objects.filter(avatar=name).exists():
+        User._meta.get_field("avatar").storage.delete(name)
+
+    used = set(
+        Thumbnail.objects.filter(image__in=thumbnails).values_list("image", flat=True)
+    )
+    storage = Thumbnail._meta.get_field("image").storage
+    for thumbnail in set(thumbnails) - used:
+        storage.delete(thumbnail)
+
+
+def set_avatar(user: User, image: Download) -> User:
+    """Store the downloaded image as the user's avatar under its content hash,
+    users with the same image share the file. The user itself isn't saved.
+    Images failing Saleor's validation are rejected, the current avatar kept"""
+
+    name = avatar_name(image)
+    stored = user.avatar.storage.exists(name)
+    file = UploadedFile(
+        file=image.file,
+        name=name.rsplit("/", 1)[-1],
+        content_type=image.content_type,
+        size=image.size,
+    )
+    if not stored:
+        try:
+            validate_image_file(file, "image", AccountErrorCode)
+        except ValidationError:
+            raise InvalidAvatarError(user.avatar_uri, "invalid image")
+
+    if user.avatar and user.avatar.name != name:
+        release_avatar(user)
+    if stored:
+        user.avatar.name = name
+        return user
+
+    # written now, the downloaded file is gone once the user is saved
+    user.avatar.save(file.name, file, save=False)
+
+    return user
+
+
+def share_thumbnails(user: User) -> bool:
+    """Give the user the thumbnails of another user with the same avatar
+    file, returns False if there are none to share"""
+
+    from saleor.thumbnail.models import Thumbnail
+
+    thumbnails = Thumbnail.objects.filter(
+        user__avatar=user.avatar.name, user__isnull=False
+    ).exclude(user=user)
+    first = thumbnails.first()
+    if not first:
+        return False
+
+    Thumbnail.objects.bulk_create(
+        [
+            Thumbnail(image=t.image.name, size=t.size, format=t.format, user=user)
+            for t in thumbnails.filter(user_id=first.user_id)
+        ]
+    )
+    return True
@@ -0,0 +1,113 @@
+"""Import time of the plugin module, as paid by every Saleor process.
+
+Needs a configured Saleor, i.e.:
+
+DJANGO_SETTINGS_MODULE=saleor.settings python -m \
+    saleor_external_auth_plugin.benchmarks.import_time --runs 10
+
+Each run is a fresh interpreter with Django set up, then imports
+saleor_external_auth_plugin.plugin and calls its warm_up. Reports the
+median and max of both and the slowest modules the plugin import loaded
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+START = "-- plugin import start --"
+END = "-- plugin import end --"
+
+SCRIPT = f"""
+import json, sys, time
+import django
+
+django.setup()
+modules = len(sys.modules)
+print({START!r}, file=sys.stderr, flush=True)
+start = time.perf_counter()
+import saleor_external_auth_plugin.plugin as plugin
+imported = time.perf_counter() - start
+print({END!r}, file=sys.stderr, flush=True)
+imported_modules = len(sys.modules) - modules
+start = time.perf_counter()
+plugin.warm_up()
+print(json.dumps({{
+    "import_s": imported,
+    "import_modules": imported_modules,
+    "warm_up_s": time.perf_counter() - start,
+    "warm_up_modules": len(sys.modules) - modules - imported_modules,
+}}))
+"""
+
+
+def run_once(importtime: bool = False) -> subprocess.CompletedProcess:
+    flags = ["-X", "importtime"] if importtime else []
+    return subprocess.run(
+        [sys.executable, *flags, "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def slowest_imports(stderr: str, top: int) -> list:
+    """Modules imported by the plugin with the highest self time, from
+    the output of python -X importtime"""
+
+    lines = stderr.split(START, 1)[-1].split(END, 1)[0].splitlines()
+    imports = []
+    for line in lines:
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        imports.append((int(self_us), int(cumulative_us), name.strip()))
+    imports.sort(reverse=True)
+    return [
+        {"module": name, "self_ms": self_us / 1000, "cumulative_ms": total / 1000}
+        for self_us, total, name in imports[:top]
+    ]
+
+
+def run(args: argparse.Namespace) -> dict:
+    results = [json.loads(run_once().stdout) for _ in range(args.runs)]
+
+    def summary(key: str) -> dict:
+        values = [r[key] for r in results]
+        return {
+            "median_ms": round(statistics.median(values) * 1000, 3),
+            "max_ms": round(max(values) * 1000, 3),
+        }
+
+    return {
+        "runs": args.runs,
+        "import": {**summary("import_s"), "modules": results[0]["import_modules"]},
+        "warm_up": {
+            **summary("warm_up_s"),
+            "modules": results[0]["warm_up_modules"],
+        },
+        "slowest_imports": slowest_imports(run_once(True).stderr, args.top),
+    }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports")
+    parser.add_argument("--output", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text)
+
+
+if __name__ == "__main__":
+    main()
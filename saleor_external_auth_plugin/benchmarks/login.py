@@ -0,0 +1,200 @@
+"""End to end login benchmark against a local stub provider.
+
+Needs a configured Saleor (database included), i.e.:
+
+DJANGO_SETTINGS_MODULE=saleor.settings python -m \
+    saleor_external_auth_plugin.benchmarks.login --logins 500 --concurrency 20
+
+Reports throughput, p50/p95/p99 latency of each pipeline stage and the
+database queries per login. Benchmark users are named bench-*@example.com
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import django
+
+from .stub_provider import StubProvider, StubSettings
+
+
+class Recorder:
+    """Collects the latencies (seconds) by stage and queries by login"""
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self.queries: List[int] = []
+        self.errors: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.timings[stage].append(seconds)
+
+    def timed(self, stage: str, fn: Callable) -> Callable:
+        def run(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        run.optional = getattr(fn, "optional", False)
+        return run
+
+    def report(self, elapsed: float) -> dict:
+        def percentiles(values: List[float]) -> dict:
+            if len(values) < 2:
+                values = values * 2 or [0.0, 0.0]
+            cuts = statistics.quantiles(values, n=100, method="inclusive")
+            return {
+                "count": len(values),
+                "p50_ms": round(cuts[49] * 1000, 3),
+                "p95_ms": round(cuts[94] * 1000, 3),
+                "p99_ms": round(cuts[98] * 1000, 3),
+            }
+
+        logins = len(self.timings["login"])
+        return {
+            "logins": logins,
+            "errors": dict(self.errors),
+            "elapsed_s": round(elapsed, 3),
+            "throughput_per_s": round(logins / elapsed, 2) if elapsed else 0,
+            "queries_per_login": {
+                "mean": round(statistics.mean(self.queries), 2) if self.queries else 0,
+                "max": max(self.queries, default=0),
+            },
+            "stages": {k: percentiles(v) for k, v in self.timings.items()},
+        }
+
+
+@contextmanager
+def count_queries(counter: List[int]):
+    from django.db import connection
+
+    def wrapper(execute, sql, params, many, context):
+        counter[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        yield
+
+
+def run(args: argparse.Namespace) -> dict:
+    django.setup()
+
+    from django.db import connection
+    from django.test import RequestFactory
+
+    from .. import external_auth as ea
+    from .. import pipeline, ratelimit, tasks
+    from ..constants import CONFIGURATION_FIELD
+    from ..plugin import ExternalAuthPlugin
+
+    recorder = Recorder()
+    # all the logins come from the same client
+    ratelimit._limiter = ratelimit.RateLimiter(None, rejected_size=0)
+    ea.tokens = pipeline.budget_pipe(
+        *[recorder.timed(stage.__name__, stage) for stage in ea.TOKENS_STAGES]
+    )
+    if args.avatars:
+        # run the avatar task inline to measure it
+        avatar_task = recorder.timed("sync_user_avatar", tasks.sync_user_avatar_task)
+        tasks.sync_user_avatar_task.delay = lambda **kwargs: avatar_task(**kwargs)
+    else:
+        tasks.sync_user_avatar_task.delay = lambda **kwargs: None
+
+    settings = StubSettings(
+        latency=args.latency / 1000,
+        error_rate=args.error_rate,
+        payload_size=args.payload_size,
+        avatar_size=args.avatar_size,
+    )
+    with StubProvider(settings) as stub:
+        plugin = ExternalAuthPlugin(
+            configuration=[
+                {"name": CONFIGURATION_FIELD, "value": stub.providers_config()}
+            ],
+            active=True,
+        )
+        factory = RequestFactory()
+
+        def login(n: int) -> None:
+            request = factory.post("/graphql/")
+            queries = [0]
+            start = time.perf_counter()
+            try:
+                with count_queries(queries):
+                    url = recorder.timed(
+                        "external_authentication_url",
+                        plugin.external_authentication_url,
+                    )({"provider": "stub"}, request)
+                    state = parse_qs(urlparse(url["authorizationUrl"]).query)["state"]
+                    plugin.external_obtain_access_tokens(
+                        {
+                            "provider": "stub",
+                            # unique codes, repeated ones get cached tokens
+                            "code": f"bench-{n % args.users}.{n}",
+                            "state": state[0],
+                        },
+                        request,
+                        None,
+                    )
+                recorder.record("login", time.perf_counter() - start)
+                recorder.queries.append(queries[0])
+            except Exception as e:
+                with recorder._lock:
+                    recorder.errors[type(e).__name__] += 1
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(login, range(args.logins)))
+        report = recorder.report(time.perf_counter() - start)
+        report["provider_requests"] = dict(stub.server.requests)
+
+    if args.cleanup:
+        from saleor.account.models import User
+
+        User.objects.filter(
+            email__startswith="bench-", email__endswith="@example.com"
+        ).delete()
+
+    return report
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--users", type=int, default=50, help="distinct users")
+    parser.add_argument("--latency", type=float, default=0, help="provider ms")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--payload-size", type=int, default=0, help="user info")
+    parser.add_argument("--avatar-size", type=int, default=64, help="pixels")
+    parser.add_argument("--avatars", action="store_true", help="fetch avatars")
+    parser.add_argument("--cleanup", action="store_true", help="delete users")
+    parser.add_argument("--output", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Time and allocations per call of the utils and config loading functions.
+
+Runs on synthetic configurations of 2 to 500 providers and user infos of
+increasing nesting depth (like Facebook's "picture"), i.e.:
+
+python -m saleor_external_auth_plugin.benchmarks.micro --save micro.json
+python -m saleor_external_auth_plugin.benchmarks.micro --baseline micro.json
+
+Loading the configuration (the "config" cases) needs a configured Saleor,
+i.e. DJANGO_SETTINGS_MODULE=saleor.settings, the utils cases run anywhere.
+Compared with a baseline it exits with status 1 when a case got slower or
+allocates more than the thresholds allow
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .. import utils as u
+from ..external_auth_types import Uri
+
+PROVIDERS = (2, 10, 100, 500)
+DEPTHS = (1, 4, 16)
+
+Case = Tuple[str, Callable[[], Any]]
+
+
+def synthetic_config(providers: int) -> dict:
+    """A configuration of 'providers' providers, as parsed from its YAML"""
+
+    return {
+        f"Provider{i}": {
+            "name": f"provider{i}",
+            "client_id": f"client id {i}",
+            "client_secret": f"client secret {i}",
+            "redirect_uri": f"http://localhost:3000/auth/provider{i}",
+            "auth_uri": {
+                "path": f"https://provider{i}.com/oauth2/auth",
+                "extra_params": {"scope": "openid email profile"},
+            },
+            "tokens_uri": {
+                "path": f"https://provider{i}.com/oauth2/token",
+                "extra_params": {"grant_type": "authorization_code"},
+            },
+            "user_info_uri": {"path": f"https://provider{i}.com/userinfo"},
+        }
+        for i in range(providers)
+    }
+
+
+def synthetic_config_text(providers: int) -> str:
+    # JSON is valid YAML
+    return json.dumps(synthetic_config(providers), indent=2)
+
+
+def synthetic_user_info(depth: int) -> dict:
+    """A user info with its avatar url 'depth' dicts deep, after the
+    other fields"""
+
+    picture: Dict[str, Any] = {"url": "https://cdn.com/pic.jpg", "width": 50}
+    for level in range(depth - 1):
+        picture = {"height": 50, "is_silhouette": False, f"level{level}": picture}
+    return {
+        "id": "1234",
+        "email": "john@doe.com",
+        "first_name": "John",
+        "last_name": "Doe",
+        "picture": picture,
+    }
+
+
+def utils_cases() -> Iterator[Case]:
+    functions = [str.strip] * 10
+    yield "pipe", lambda: u.pipe(" value ", *functions)
+    uri = u.make_uri("https://provider.com/oauth2/auth")
+    params = {"client_id": "id", "scope": "openid email profile", "state": "x" * 43}
+    yield "make_uri", lambda: uri(params)
+    for providers in PROVIDERS:
+        config = synthetic_config(providers)
+        yield (
+            f"dict_keys_to_lower[providers={providers}]",
+            lambda config=config: u.dict_keys_to_lower(config),
+        )
+        yield (
+            f"instantiate[providers={providers}]",
+            lambda config=config: u.instantiate(Uri)(config),
+        )
+    lookup = u.dict_str_lookup("http")
+    for depth in DEPTHS:
+        user_info = synthetic_user_info(depth)
+        yield (
+            f"dict_str_lookup[depth={depth}]",
+            lambda user_info=user_info: lookup(user_info),
+        )
+
+
+def config_cases() -> Iterator[Case]:
+    import django
+
+    django.setup()
+    from .. import external_auth as ea
+
+    for providers in PROVIDERS:
+        text = synthetic_config_text(providers)
+        configuration = [{"name": "providers_config_list", "value": text}]
+        yield (
+            f"parse_providers_config[providers={providers}]",
+            lambda text=text: ea.parse_providers_config(text),
+        )
+        # cached by the configuration text's hash after the first call
+        yield (
+            f"get_providers_from_config[providers={providers}]",
+            lambda configuration=configuration: ea.get_providers_from_config(
+                configuration
+            ),
+        )
+
+
+GROUPS = {"utils": utils_cases, "config": config_cases}
+
+
+def measure(fn: Callable[[], Any], min_seconds: float, repeat: int) -> dict:
+    """Best time per call over 'repeat' runs of at least 'min_seconds',
+    and the memory (bytes and blocks) one call allocates and keeps alive
+    at its peak"""
+
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+        number *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        blocks = sum(
+            stat.count_diff
+            for stat in tracemalloc.take_snapshot().compare_to(snapshot, "filename")
+        )
+        del result
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "us_per_call": round(best / number * 1e6, 3),
+        "peak_bytes": peak - before,
+        "blocks": max(blocks, 0),
+    }
+
+
+def run(cases: List[Case], min_seconds: float, repeat: int) -> Dict[str, dict]:
+    return {name: measure(fn, min_seconds, repeat) for name, fn in cases}
+
+
+def regressions(
+    results: Dict[str, dict],
+    baseline: Dict[str, dict],
+    time_threshold: float,
+    memory_threshold: float,
+) -> List[str]:
+    """Cases slower than their baseline by more than 'time_threshold' or
+    allocating more than 'memory_threshold' (fractions of the baseline)"""
+
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        limits = {
+            "us_per_call": time_threshold,
+            "peak_bytes": memory_threshold,
+            "blocks": memory_threshold,
+        }
+        for metric, threshold in limits.items():
+            if result[metric] > base[metric] * (1 + threshold):
+                found.append(
+                    f"{name}: {metric} {result[metric]} > {base[metric]} "
+                    f"+{threshold:.0%}"
+                )
+    return found
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--group", choices=[*GROUPS, "all"], default="all", help="cases to run"
+    )
+    parser.add_argument("--min-seconds", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--time-threshold", type=float, default=0.25)
+    parser.add_argument("--memory-threshold", type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> Optional[int]:
+    args = parse_args(argv)
+    groups = GROUPS if args.group == "all" else {args.group: GROUPS[args.group]}
+    cases = [case for group in groups.values() for case in group()]
+    results = run(cases, args.min_seconds, args.repeat)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.save:
+        with open(args.save, "w") as output:
+            output.write(text)
+    if not args.baseline:
+        return None
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    found = regressions(results, baseline, args.time_threshold, args.memory_threshold)
+    for regression in found:
+        print(regression, file=sys.stderr)
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
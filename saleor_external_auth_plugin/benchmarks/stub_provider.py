@@ -0,0 +1,174 @@
+"""A local OAuth provider (token, user info and avatar endpoints) for
+benchmarks, with configurable latency, error rate and payload size"""
+
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+
+def make_png(size: int) -> bytes:
+    """A valid grayscale 'size' x 'size' PNG image"""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    rows = b"".join(
+        b"\x00" + bytes(random.getrandbits(8) for _ in range(size)) for _ in range(size)
+    )
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 0, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+@dataclass
+class StubSettings:
+    latency: float = 0.0
+    error_rate: float = 0.0
+    # bytes of padding added to each user info response
+    payload_size: int = 0
+    avatar_size: int = 64
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StubServer"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body: dict) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def simulate(self) -> bool:
+        """Apply the latency, returns False if this request should fail"""
+
+        settings = self.server.settings
+        if settings.latency:
+            time.sleep(settings.latency)
+        self.server.count(urlparse(self.path).path)
+        if random.random() < settings.error_rate:
+            self.send_json(500, {"error": "server_error"})
+            return False
+        return True
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        if not self.simulate():
+            return
+
+        if urlparse(self.path).path != "/token":
+            return self.send_json(404, {"error": "not_found"})
+        # the code is used as access token so user info knows who logged
+        # in, the user is the code up to its first "."
+        code = form.get("code", [""])[0]
+        self.send_json(200, {"access_token": code, "token_type": "Bearer"})
+
+    def do_GET(self) -> None:
+        if not self.simulate():
+            return
+
+        path = urlparse(self.path).path
+        if path == "/userinfo":
+            token = self.headers.get("Authorization", "").split(" ")[-1]
+            user = token.split(".")[0]
+            return self.send_json(
+                200,
+                {
+                    "id": user,
+                    "email": f"{user}@example.com",
+                    "given_name": "Bench",
+                    "family_name": user,
+                    "picture": f"{self.server.url}/avatar.png?user={user}",
+                    "padding": "x" * self.server.settings.payload_size,
+                },
+            )
+        if path == "/avatar.png":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(self.server.avatar)))
+            self.end_headers()
+            self.wfile.write(self.server.avatar)
+            return
+
+        self.send_json(404, {"error": "not_found"})
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, settings: StubSettings) -> None:
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.settings = settings
+        self.avatar = make_png(settings.avatar_size)
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, path: str) -> None:
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+
+class StubProvider:
+    """Runs a StubServer in a background thread:
+
+    with StubProvider(StubSettings(latency=0.05)) as stub:
+        config = stub.providers_config()
+    """
+
+    def __init__(self, settings: Optional[StubSettings] = None) -> None:
+        self.server = StubServer(settings or StubSettings())
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "StubProvider":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self) -> str:
+        return self.server.url
+
+    def providers_config(self, name: str = "stub") -> str:
+        """Plugin configuration (YAML) pointing a provider at this server"""
+
+        return f"""
+{name}:
+    name: "{name}"
+    client_id: "stub client"
+    client_secret: "stub secret"
+    redirect_uri: "http://localhost:3000/auth/{name}"
+    auth_uri:
+        path: "{self.url}/auth"
+        extra_params:
+            response_type: "code"
+    tokens_uri:
+        path: "{self.url}/token"
+        extra_params:
+            grant_type: "authorization_code"
+    user_info_uri:
+        path: "{self.url}/userinfo"
+"""
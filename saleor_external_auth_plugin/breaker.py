@@ -0,0 +1,111 @@
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+from . import metrics
+from .external_auth_types import (
+    CircuitBreakerConfig,
+    Provider,
+    ProviderUnavailableError,
+)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# gauge values of each state
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+BREAKER_STATE = "external_auth_circuit_breaker_state"
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, config: CircuitBreakerConfig) -> None:
+        self.name = name
+        self.config = config
+        self.state = CLOSED
+        # (succeeded, seconds) of the last calls
+        self._calls: Deque[Tuple[bool, float]] = deque(maxlen=config.window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state == CLOSED:
+            self._calls.clear()
+        sink = metrics.get_sink()
+        if sink:
+            sink.gauge(BREAKER_STATE, STATE_VALUES[state], {"provider": self.name})
+
+    def before_call(self) -> None:
+        """Raise ProviderUnavailableError if the call must not be made"""
+
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.config.open_seconds:
+                    raise ProviderUnavailableError(self.name)
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                # a single call probes the provider
+                if self._probing:
+                    raise ProviderUnavailableError(self.name)
+                self._probing = True
+
+    def record(self, succeeded: bool, seconds: float) -> None:
+        config = self.config
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                healthy = succeeded and seconds < config.slow_call_seconds
+                self._set_state(CLOSED if healthy else OPEN)
+                return
+
+            self._calls.append((succeeded, seconds))
+            calls = len(self._calls)
+            if self.state != CLOSED or calls < config.min_calls:
+                return
+
+            failed = sum(1 for ok, _ in self._calls if not ok)
+            slow = sum(1 for _, s in self._calls if s >= config.slow_call_seconds)
+            if (
+                failed / calls >= config.error_rate
+                or slow / calls >= config.slow_call_rate
+            ):
+                self._set_state(OPEN)
+
+    def read_timeout(self, configured: float) -> float:
+        """'configured' read timeout lowered to a multiple of the p99 latency
+        of the last successful calls, never under the configured minimum"""
+
+        config = self.config
+        latencies = [s for ok, s in list(self._calls) if ok]
+        if not config.adaptive_timeout or len(latencies) < config.min_calls:
+            return configured
+        p99 = statistics.quantiles(latencies, n=100, method="inclusive")[98]
+        return min(configured, max(config.min_timeout, p99 * config.timeout_multiplier))
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider: Provider) -> CircuitBreaker:
+    """Process wide breaker of 'provider', reset when its configuration changes"""
+
+    breaker = _breakers.get(provider.name)
+    if breaker and breaker.config == provider.circuit_breaker:
+        return breaker
+
+    with _breakers_lock:
+        breaker = _breakers.get(provider.name)
+        if not breaker or breaker.config != provider.circuit_breaker:
+            breaker = CircuitBreaker(provider.name, provider.circuit_breaker)
+            _breakers[provider.name] = breaker
+        return breaker
+
+
+def breaker_states() -> Dict[str, str]:
+    return {name: breaker.state for name, breaker in list(_breakers.items())}
@@ -0,0 +1,11 @@
+from typing import Any
+
+from django.conf import settings
+
+from . import constants
+
+
+def get_setting(name: str) -> Any:
+    """Deployment setting 'name', read from Django's settings as
+    EXTERNAL_AUTH_<name> with the default from constants"""
+    return getattr(settings, f"EXTERNAL_AUTH_{name}", getattr(constants, name))
@@ -1,4 +1,85 @@
 CONFIGURATION_FIELD = "providers_config_list"
+# States are made by token_urlsafe(32), longer ones aren't even looked up
+MAX_STATE_LENGTH = 64
+# Parsed configurations kept in memory, by hash of the configuration text
+PROVIDERS_CACHE_SIZE = 16
+# Avatars are fetched by a celery task, with at most this many
+# downloads at once per worker process
+AVATAR_SYNC_CONCURRENCY = 4
+AVATAR_SYNC_MAX_RETRIES = 3
+# Private metadata key of the user's avatar source (url, etag, hash...)
+AVATAR_METADATA_KEY = "external_auth.avatar"
+# Seconds a replaced avatar's files are kept before being deleted if unused
+AVATAR_DELETE_DELAY = 3600
+# Avatars are streamed in chunks of this size, kept in memory up to
+# AVATAR_SPOOL_SIZE bytes and on a temporary file above that
+AVATAR_CHUNK_SIZE = 64 * 1024
+AVATAR_SPOOL_SIZE = 512 * 1024
+# Image types accepted as avatars, by patterns of their leading bytes
+AVATAR_SIGNATURES = {
+    "image/png": rb"\x89PNG\r\n\x1a\n",
+    "image/jpeg": rb"\xff\xd8\xff",
+    "image/gif": rb"GIF8[79]a",
+    "image/webp": rb"RIFF....WEBP",
+}
+
+# Defaults of the settings that can be overridden in Django's settings
+# by prefixing their names with EXTERNAL_AUTH_ (see conf.get_setting)
+
+# Where the states of authentication urls are kept until their callback,
+# "cache" (a Django cache) or "memory" (only for single process deployments)
+STATE_STORE = "cache"
+STATE_CACHE_ALIAS = "default"
+STATE_MEMORY_SIZE = 10000
+# Seconds an authentication url can be used
+STATE_TTL = 600
+# Seconds the tokens of an authorization code are kept in the state store
+# for repeated submissions of the same code, 0 disables it
+TOKENS_CACHE_TTL = 60
+# Bytes an avatar download can have, it's aborted as soon as it's bigger
+AVATAR_MAX_SIZE = 5 * 1024 * 1024
+# Seconds a login (the tokens pipeline) can take, provider calls get what's
+# left as timeout. None disables the limit
+LOGIN_BUDGET = 10.0
+# Optional stages (i.e. scheduling the avatar download) are skipped when
+# less than this is left
+OPTIONAL_STAGE_MIN_BUDGET = 1.0
+# Returning users' last_login is written in bulk from a "memory" (per
+# process) or "cache" (the LAST_LOGIN_CACHE_ALIAS Django cache) buffer when
+# LAST_LOGIN_FLUSH_SIZE are pending or the oldest waited
+# LAST_LOGIN_MAX_STALENESS seconds. None writes it with each login
+LAST_LOGIN_BUFFER = None
+LAST_LOGIN_CACHE_ALIAS = "default"
+LAST_LOGIN_FLUSH_SIZE = 500
+LAST_LOGIN_MAX_STALENESS = 30
+# Fraction of logins profiled (cProfile and tracemalloc), 0 disables it.
+# Also set by the EXTERNAL_AUTH_PROFILE_RATE environment variable, read
+# once per process. Each login's files go to PROFILE_DIR, which keeps the
+# last PROFILE_MAX_LOGINS
+PROFILE_RATE = 0
+PROFILE_DIR = "/tmp/external_auth_profiles"
+PROFILE_MAX_LOGINS = 100
+# Token buckets limiting externalObtainAccessTokens before any provider call,
+# "memory" (per process), "cache" (the RATE_LIMIT_CACHE_ALIAS Django cache,
+# shared but approximate under contention) or None to disable them.
+# Rates are tokens per second, bursts the size of the buckets
+RATE_LIMIT_STORE = "memory"
+RATE_LIMIT_CACHE_ALIAS = "default"
+RATE_LIMIT_MEMORY_SIZE = 10000
+RATE_LIMIT_IP_RATE = 0.5
+RATE_LIMIT_IP_BURST = 10
+RATE_LIMIT_PROVIDER_RATE = 50.0
+RATE_LIMIT_PROVIDER_BURST = 200
+# Proxies in front of Saleor appending to X-Forwarded-For, the client's IP is
+# the address they received the request from. None trusts the whole header
+# (Saleor's get_client_ip) which clients can forge to dodge their bucket
+RATE_LIMIT_TRUSTED_PROXIES = None
+# Seconds rejected payloads (malformed, unknown provider or state) are
+# remembered and rejected again without looking them up
+REJECTED_PAYLOAD_TTL = 300
+# Dotted path to a metrics.MetricsSink factory, i.e.
+# "saleor_external_auth_plugin.metrics.PrometheusSink", None disables metrics
+METRICS_SINK = None
 DEFAULT_CONFIGURATION_TEXT = """---
 # Configuration in YAML format
 # A dict with providers identified by name and 
@@ -19,6 +100,46 @@ DEFAULT_CONFIGURATION_TEXT = """---
 #             scope: "email profile"
 #             access_type: "offline"
 #
+# any uri may also set a "timeout" (seconds) for reading its response
+#
+# each provider may have an optional "http" dict setting its
+# connection pool and how its HTTP calls are made, defaults are:
+#
+# http:
+#     pool_size: 10
+#     connect_timeout: 3.05
+#     read_timeout: 10
+#     retries: 2  # only GET requests are retried
+#     backoff_factor: 0.3
+#
+# PKCE is used unless the provider sets "pkce: false"
+#
+# "avatar_refresh_interval" (seconds) makes avatars be checked for changes
+# on login at most once per interval, by default they are never refreshed
+#
+# each provider's calls go through a circuit breaker that can be tuned or
+# disabled with a "circuit_breaker" dict, defaults are:
+#
+# circuit_breaker:
+#     enabled: true
+#     window: 50  # number of last calls considered
+#     min_calls: 10
+#     error_rate: 0.5  # opens when this rate of calls fail
+#     slow_call_seconds: 5
+#     slow_call_rate: 0.5  # or when this rate of calls are slow
+#     open_seconds: 30  # then calls fail fast for this long
+#     adaptive_timeout: true  # read timeout lowered to p99 * multiplier
+#     timeout_multiplier: 3
+#     min_timeout: 1
+#
+# OpenID Connect providers may set an "oidc" dict, then the user info is
+# read from the verified id_token instead of calling user_info_uri:
+#
+# oidc:
+#     discovery_uri: "https://accounts.google.com/.well-known/openid-configuration"
+#     cache_ttl: 3600  # seconds the discovery document and keys are cached
+#     leeway: 60  # seconds of clock skew tolerated in the token's timestamps
+#
 google: 
     name: "google"
     client_id: "your google id"
@@ -1,85 +1,251 @@
+import base64
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
 from functools import reduce
+from types import MappingProxyType
 import yaml
 import requests
-from typing import Callable, Dict, Optional, Tuple
+from typing import Callable, List, Mapping, Optional, Tuple
+from django.db import IntegrityError, transaction
 from django.utils import timezone
-from django.core.exceptions import ValidationError
 from django.middleware import csrf
-from django.core.files.uploadedfile import SimpleUploadedFile
 
 from saleor.account.models import User
-from saleor.account.thumbnails import create_user_avatar_thumbnails
-from saleor.graphql.core.utils import add_hash_to_file_name, validate_image_file
 from saleor.core import jwt
 
+from . import avatars, constants, http_client, last_login, metrics, oidc
+from .conf import get_setting
+from .models import ExternalIdentity
+from .pipeline import budget_pipe, optional
+from .ratelimit import get_rate_limiter
+from .state import get_state_store
 from . import utils as u
+from .tasks import sync_user_avatar_task
 from .external_auth_types import (
     Context,
     ExternalAccessTokens,
     ExternalAuthError,
     Provider,
     PluginConfigurationType,
-    Uri,
 )
 
 
+def parse_providers_config(providers_config: str) -> Mapping[str, Provider]:
+    config = u.pipe(providers_config, yaml.safe_load, u.dict_keys_to_lower)
+    if not config:
+        raise ExternalAuthError("No provider configuration available", "config")
+
+    load_provider = u.load(Provider)
+    try:
+        return MappingProxyType(
+            {
+                u.lookup_name(name): load_provider(value, name)
+                for name, value in config.items()
+            }
+        )
+    except TypeError as e:
+        raise ExternalAuthError(f"Invalid provider configuration {e}", "config")
+
+
+_providers_cache: "OrderedDict[str, Mapping[str, Provider]]" = OrderedDict()
+_providers_cache_lock = threading.Lock()
+
+
 def get_providers_from_config(
     configuration: PluginConfigurationType,
-) -> Dict[str, Provider]:
+) -> Mapping[str, Provider]:
+    """Providers parsed from the configuration text, the (read only) result is
+    cached by the text's hash so plugin instances share it"""
+
     try:
         providers_config = configuration[0]["value"]
-        return u.pipe(
-            providers_config,
-            yaml.safe_load,
-            u.dict_keys_to_lower,
-            u.instantiate(Uri),
-            u.instantiate(Provider),
-        )
+        key = hashlib.sha256(str(providers_config).encode()).hexdigest()
+        with _providers_cache_lock:
+            if key in _providers_cache:
+                _providers_cache.move_to_end(key)
+                return _providers_cache[key]
+
+        providers = parse_providers_config(providers_config)
+        with _providers_cache_lock:
+            _providers_cache[key] = providers
+            if len(_providers_cache) > constants.PROVIDERS_CACHE_SIZE:
+                _providers_cache.popitem(last=False)
+        return providers
     except (IndexError, TypeError):
-        raise ExternalAuthError("No provider configuration available")
+        raise ExternalAuthError("No provider configuration available", "config")
+
+
+def clear_providers_cache() -> None:
+    with _providers_cache_lock:
+        _providers_cache.clear()
 
 
-def get_context(providers: Dict[str, Provider]) -> Callable[[dict], Context]:
+def get_context(providers: Mapping[str, Provider]) -> Callable[[dict], Context]:
     """Get the authentication context merging the request payload
     and the selected provider from configuration"""
 
     def set_payload(payload: dict) -> Context:
         try:
-            provider = providers.get(payload.get("provider").lower())
+            provider = providers.get(u.lookup_name(payload.get("provider")))
             if not provider:
-                raise ExternalAuthError(f"Provider not found in configuration")
+                raise ExternalAuthError(
+                    "Provider not found in configuration", "unknown_provider"
+                )
         except AttributeError:
-            raise ExternalAuthError(f"Provider not found in configuration")
+            raise ExternalAuthError(
+                "Provider not found in configuration", "unknown_provider"
+            )
 
         return Context(payload=payload, provider=provider)
 
     return set_payload
 
 
-def sanitize_secret(allowed_chars: str) -> Callable[[str], str]:
-    """Let only allowed chars in secret string"""
+def pkce_challenge(verifier: str) -> str:
+    digest = hashlib.sha256(verifier.encode()).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def get_state(context: Context) -> dict:
+    """Authentication url params binding the url to this request: a random
+    single use state, plus the PKCE challenge and OpenID nonce. What's needed
+    to check them in the callback is kept in the state store"""
+
+    state, stored, params = make_state(context)
+    get_state_store().put(state, stored, get_setting("STATE_TTL"))
+    return params
 
-    def inner(secret: str) -> str:
-        return "".join(filter(lambda char: char in allowed_chars, str(secret)))
 
-    return inner
+def make_state(context: Context) -> Tuple[str, dict, dict]:
+    """State, what to store with it and the url params of 'get_state'"""
+
+    provider = context.provider
+    state = secrets.token_urlsafe(32)
+    stored = {"provider": provider.name}
+    params = {"state": state}
+
+    if provider.pkce:
+        stored["code_verifier"] = secrets.token_urlsafe(64)
+        params["code_challenge"] = pkce_challenge(stored["code_verifier"])
+        params["code_challenge_method"] = "S256"
+    if provider.oidc:
+        stored["nonce"] = params["nonce"] = secrets.token_urlsafe(16)
+
+    return state, stored, params
+
+
+def authorization_url(context: Context, state_params: dict) -> str:
+    return context.provider.authorization_url(
+        {
+            "redirect_uri": context.payload.get(
+                "redirectUri", context.provider.redirect_uri
+            ),
+            **state_params,
+        }
+    )
 
 
-def get_state(secret: str) -> str:
-    """build state string from secret"""
-    clean_secret = sanitize_secret(csrf.CSRF_ALLOWED_CHARS)(secret)
-    return csrf._mask_cipher_secret(clean_secret)
+def requested_providers(
+    providers: Mapping[str, Provider], payload: dict
+) -> Optional[List[str]]:
+    """Names in the payload's "providers": "all" or a list of names,
+    None when a single "provider" is requested"""
+
+    requested = payload.get("providers")
+    if requested is None:
+        return None
+    if requested == "all":
+        return [name for name, p in providers.items() if p.auth_url]
+    if not isinstance(requested, list) or not all(
+        isinstance(name, str) for name in requested
+    ):
+        raise ExternalAuthError("Invalid providers list", "invalid_payload")
+
+    names = list(dict.fromkeys(u.lookup_name(name) for name in requested))
+    unknown = [name for name in names if name not in providers]
+    if unknown:
+        raise ExternalAuthError(
+            f"Providers not found in configuration: {', '.join(unknown)}",
+            "unknown_provider",
+        )
+    return names
+
+
+def authorization_urls(
+    providers: Mapping[str, Provider], names: List[str], payload: dict
+) -> dict:
+    """Authorization url of each provider in 'names', their states
+    stored at once"""
+
+    urls, states = {}, {}
+    for name in names:
+        context = Context(
+            payload={**payload, "provider": name}, provider=providers[name]
+        )
+        state, stored, params = make_state(context)
+        states[state] = stored
+        urls[name] = authorization_url(context, params)
+
+    get_state_store().put_many(states, get_setting("STATE_TTL"))
+    return urls
 
 
 def check_state(context: Context) -> Context:
-    """Check if state string was made from provider's client_id"""
+    """Consume the request's state, rejecting unknown, expired or
+    already used states before any request to the provider"""
 
-    secret = sanitize_secret(csrf.CSRF_ALLOWED_CHARS)(context.provider.client_id)
     state = context.payload.get("state")
+    stored = (
+        get_state_store().pop(state)
+        if isinstance(state, str) and len(state) <= constants.MAX_STATE_LENGTH
+        else None
+    )
+
+    if not stored or stored.get("provider") != context.provider.name:
+        raise ExternalAuthError("Invalid request state", "invalid_state")
+
+    return context.with_data(state=stored)
+
+
+def raise_for_error(response: dict) -> dict:
+    """Raise the error message returned by the provider, if any"""
 
-    if not secret.startswith(csrf._unmask_cipher_token(state)):
-        raise ExternalAuthError(f"Invalid request state")
+    if response.get("error"):
+        raise ExternalAuthError(" ".join(map(str, response.values())), "provider_error")
+
+    return response
+
+
+def credentials_request(context: Context) -> dict:
+    """Form data to exchange the code for credentials"""
 
+    provider = context.provider
+    payload = context.payload
+    data = {
+        **provider.tokens_data,
+        "code": payload.get("code"),
+        "redirect_uri": payload.get("redirectUri", provider.redirect_uri),
+    }
+    code_verifier = (context.data or {}).get("state", {}).get("code_verifier")
+    if code_verifier:
+        data["code_verifier"] = code_verifier
+    return data
+
+
+def credentials_error(provider: Provider) -> ExternalAuthError:
+    return ExternalAuthError(
+        f"Could not get credentials from {provider.name} authorization server, check CLIENT_ID, CLIENT_SECRET, TOKENS_GRANT_TYPE and TOKENS_URI in Saleor Dashboard Plugin Config and that the authentication url is returning the CODE",
+        "credentials_unavailable",
+    )
+
+
+def check_provider_rate(context: Context) -> Context:
+    """Take a token from the provider's bucket, only requests with a valid
+    state can use up the provider's rate limit"""
+
+    get_rate_limiter().check_provider(context.provider.name)
     return context
 
 
@@ -88,118 +254,230 @@ def get_credentials(context: Context) -> Context:
     in the authetication url call for authentication tokens (credentials)"""
 
     provider = context.provider
-    payload = context.payload
 
     try:
-        data = {
-            "code": payload.get("code"),
-            "client_id": provider.client_id,
-            "client_secret": provider.client_secret,
-            "redirect_uri": payload.get("redirectUri", provider.redirect_uri),
-            "grant_type": provider.tokens_uri.extra_params.get("grant_type"),
-        }
-        credentials = requests.post(provider.tokens_uri.path, data=data).json()
-        if credentials.get("error"):
-            raise ExternalAuthError(" ".join(credentials.values()))
-
-        return Context(
-            payload=payload,
-            provider=provider,
-            data={"credentials": credentials},
-        )
+        credentials = http_client.request(
+            "POST",
+            provider,
+            provider.tokens_uri.path,
+            provider.tokens_uri,
+            context.deadline,
+            data=credentials_request(context),
+        ).json()
     except requests.exceptions.RequestException:
-        raise ExternalAuthError(
-            f"Could not get credentials from {provider.provider_name} authorization server, check CLIENT_ID, CLIENT_SECRET, TOKENS_GRANT_TYPE and TOKENS_URI in Saleor Dashboard Plugin Config and that the authentication url is returning the CODE"
-        )
+        raise credentials_error(provider)
 
+    return context.with_data(credentials=raise_for_error(credentials))
 
-def get_user_info(context: Context) -> Optional[dict]:
-    """Use credentials to get user info like email, name, picture, etc."""
+
+def user_info_request(context: Context) -> Tuple[str, dict]:
+    """User info uri and headers built from the credentials"""
 
     provider = context.provider
     credentials = context.data.get("credentials")
-    user_info_uri = u.make_uri(provider.user_info_uri.path)
     headers = {
         "Authorization": f"{credentials.get('token_type')} {credentials.get('access_token')}"
     }
-    uri = user_info_uri(
-        {
-            "access_token": credentials.get("access_token"),
-            **provider.user_info_uri.extra_params,
-        }
+    uri = provider.user_info_url(credentials.get("access_token"))
+    return uri, headers
+
+
+def user_info_error(provider: Provider) -> ExternalAuthError:
+    return ExternalAuthError(
+        f"Could not get user info from {provider.name} user info server",
+        "user_info_unavailable",
     )
-    user_info = requests.get(uri, headers=headers).json()
 
-    if user_info.get("error"):
-        raise ExternalAuthError(" ".join(user_info.values()))
 
-    return user_info
+def get_user_info(context: Context) -> Context:
+    """Use credentials to get user info like email, name, picture, etc."""
+
+    provider = context.provider
+    credentials = context.data.get("credentials")
+    if oidc.can_skip_user_info(provider, credentials):
+        user_info = oidc.get_user_info(
+            provider,
+            credentials["id_token"],
+            context.data.get("state", {}).get("nonce"),
+        )
+        if user_info.get("email"):
+            return context.with_data(user_info=user_info)
+
+    uri, headers = user_info_request(context)
+    try:
+        user_info = http_client.request(
+            "GET",
+            provider,
+            uri,
+            provider.user_info_uri,
+            context.deadline,
+            headers=headers,
+        ).json()
+    except requests.exceptions.RequestException:
+        raise user_info_error(provider)
+
+    return context.with_data(user_info=raise_for_error(user_info))
+
 
+def identity_provider(name: str) -> str:
+    """Provider of the ExternalIdentity rows of the provider 'name', the
+    same for logins and provisioning whatever its case and spacing"""
 
-def get_user(user_info: Optional[dict]) -> Optional[User]:
+    return u.lookup_name(name)
+
+
+def get_user(context: Context) -> Context:
     """Get existing user from database or create a new one if not found.
     User with unverified emails are inactive until verification"""
 
-    user, created = User.objects.get_or_create(
-        email=user_info.get("email"),
-        first_name=user_info.get("first_name", user_info.get("given_name")),
-        last_name=user_info.get("last_name", user_info.get("family_name")),
+    user_info = context.data.get("user_info")
+    email, names, avatar_uri = user_info_fields(user_info)
+    provider = identity_provider(context.provider.name)
+    subject = user_subject(user_info)
+
+    # looked up by the provider's subject, then by email (unique) for users
+    # not linked yet. The user is written once in update_user
+    identity = (
+        ExternalIdentity.objects.select_related("user")
+        .filter(provider=provider, subject=subject)
+        .first()
+        if subject
+        else None
     )
+    user = identity.user if identity else None
+    if not user and email:
+        user = User.objects.filter(email=email).first()
+    if not user and not email:
+        raise ExternalAuthError(
+            f"{provider} didn't return the user's email", "user_info_unavailable"
+        )
 
-    get_user_pic = u.dict_str_lookup("http")
-    user.avatar_uri = get_user_pic(user_info)
-    return user
+    if user:
+        changed_fields = update_fields(user, names)
+    else:
+        user = User(email=email, **{k: v or "" for k, v in names.items()})
+        changed_fields = []
 
+    user.avatar_uri = avatar_uri
+    return context.with_data(
+        user=user,
+        changed_fields=changed_fields,
+        # identity to link in update_user
+        subject=subject if subject and not identity else None,
+    )
 
-def update_avatar(user: User) -> User:
-    response = requests.get(user.avatar_uri).json()
-    if response.get("error"):
-        raise ExternalAuthError(" ".join(response.values()))
 
-    content_type = response.headers["Content-Type"]
-    filename = (
-        user.email.replace("@", "").replace(".", "") + "." + content_type.split("/")[1]
-    )
+def user_subject(user_info: dict) -> Optional[str]:
+    """The provider's stable id of the user"""
 
-    file = SimpleUploadedFile(
-        content=response.content, name=filename, content_type=content_type
-    )
+    subject = user_info.get("sub") or user_info.get("id")
+    return str(subject) if subject else None
+
+
+def user_info_fields(user_info: dict) -> Tuple[str, dict, Optional[str]]:
+    """Email, names and avatar url in a provider's user info"""
 
-    validate_image_file(file, "image", ValidationError)
-    add_hash_to_file_name(file)
-    if user.avatar:
-        user.avatar.delete_sized_images()
-        user.avatar.delete()
-    user.avatar = file
+    names = {
+        "first_name": user_info.get("first_name", user_info.get("given_name")),
+        "last_name": user_info.get("last_name", user_info.get("family_name")),
+    }
+    return user_info.get("email"), names, u.dict_str_lookup("http")(user_info)
+
+
+def update_fields(user: User, values: dict) -> List[str]:
+    """Set the given values that changed, returning their field names"""
+
+    changed = [k for k, v in values.items() if v and getattr(user, k) != v]
+    for field in changed:
+        setattr(user, field, values[field])
+    return changed
+
+
+def save_user(user: User, update_fields: List[str]) -> User:
+    """Insert a new user or update only 'update_fields' of an existing one.
+    If a concurrent login inserted the same user, it gets updated instead"""
+
+    if user.pk:
+        user.save(update_fields=update_fields)
+        return user
+
+    try:
+        with transaction.atomic():
+            user.save()
+    except IntegrityError:
+        existing = User.objects.get(email=user.email)
+        user.pk, user.avatar = existing.pk, existing.avatar
+        user.private_metadata = existing.private_metadata
+        user.save(update_fields=update_fields)
 
     return user
 
 
-def update_user(user: User) -> User:
+def schedule_avatar_sync(user: User, refresh_interval: Optional[int]) -> User:
+    """Fetch or refresh the provider's avatar in background
+    once the user is committed"""
+
+    if user.avatar_uri and avatars.needs_refresh(user, refresh_interval):
+        kwargs = {
+            "user_id": user.pk,
+            "avatar_uri": user.avatar_uri,
+            "refresh_interval": refresh_interval,
+        }
+        transaction.on_commit(lambda: sync_user_avatar_task.delay(**kwargs))
+
+    return user
+
+
+def update_user(context: Context) -> Context:
     """Update existent user data with this login or
     create a new user if it's the first login"""
 
+    user = context.data.get("user")
     user.last_login = timezone.now()
-    update_fields = ["last_login"]
+    subject = context.data.get("subject")
+    changed_fields = context.data.get("changed_fields", [])
+    buffer = last_login.get_buffer()
+    if buffer and user.pk and not changed_fields and not subject:
+        # nothing else to write, last_login is written later in bulk
+        buffer.add(user.pk, user.last_login)
+        return context
+    if not subject:
+        save_user(user, ["last_login", *context.data.get("changed_fields", [])])
+        return context
+
+    with transaction.atomic():
+        save_user(user, ["last_login", *context.data.get("changed_fields", [])])
+        link_identity(user, identity_provider(context.provider.name), subject)
+    return context
 
-    if user.avatar_uri and not user.avatar:
-        user = update_avatar(user)
-        update_fields.append("avatar")
 
-    if user.id:
-        user.save(update_fields=update_fields)
-    else:
-        user.save()
+def link_identity(user: User, provider: str, subject: str) -> None:
+    """Map the provider's 'subject' to 'user', a concurrent login
+    may have done it already"""
 
-    if "avatar" in update_fields:
-        create_user_avatar_thumbnails.delay(user_id=user.pk)
+    try:
+        with transaction.atomic():
+            ExternalIdentity.objects.create(
+                provider=provider, subject=subject, user=user
+            )
+    except IntegrityError:
+        pass
 
-    return user
+
+@optional
+def sync_avatar(context: Context) -> Context:
+    """Schedule the avatar download, skipped when the login is short of time"""
+
+    schedule_avatar_sync(
+        context.data.get("user"), context.provider.avatar_refresh_interval
+    )
+    return context
 
 
-def get_tokens(user: User) -> Tuple[User, ExternalAccessTokens]:
+def get_tokens(context: Context) -> ExternalAccessTokens:
     """Get Saleor's Access Tokens with the user ID"""
 
+    user = context.data.get("user")
     csrf_token = csrf._get_new_csrf_token()
     return ExternalAccessTokens(
         user=user,
@@ -209,12 +487,18 @@ def get_tokens(user: User) -> Tuple[User, ExternalAccessTokens]:
     )
 
 
-# A pipe containing the sequence of funcions necessary to get tokens
-tokens = u.pipe(
+# The sequence of funcions necessary to get tokens
+TOKENS_STAGES = (
     check_state,
+    check_provider_rate,
     get_credentials,
     get_user_info,
     get_user,
     update_user,
+    sync_avatar,
     get_tokens,
 )
+
+# A pipe containing the sequence of funcions necessary to get tokens within
+# the login budget, measured when a metrics sink is configured
+tokens = metrics.instrument("tokens", TOKENS_STAGES, pipe=budget_pipe)
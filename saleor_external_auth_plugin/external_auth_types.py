@@ -1,12 +1,22 @@
-from dataclasses import dataclass, field
-from typing import Dict, List, Optional
+import time
+from dataclasses import dataclass, field, replace
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple
+from urllib.parse import urlencode
 
-from saleor.account.models import User
+from .utils import add_query
+
+if TYPE_CHECKING:
+    from saleor.account.models import User
 
 PluginConfigurationType = List[dict]
 NoneType = type(None)
 
 
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else deadline - time.monotonic()
+
+
 class ConfigurationTypeField:
     STRING = "String"
     MULTILINE = "Multiline"
@@ -34,13 +44,64 @@ class ExternalAccessTokens:
     user: Optional["User"] = None
 
 
-@dataclass
+@dataclass(frozen=True)
 class Uri:
     path: str
-    extra_params: Optional[Dict[str, str]] = field(default_factory=(lambda: {}))
+    extra_params: Optional[Mapping[str, str]] = field(default_factory=(lambda: {}))
+    timeout: Optional[float] = None
 
+    def __post_init__(self):
+        # read only, providers are shared by all plugin instances
+        object.__setattr__(
+            self, "extra_params", MappingProxyType(dict(self.extra_params or {}))
+        )
 
-@dataclass
+
+@dataclass(frozen=True)
+class HttpConfig:
+    """Connection pool, timeouts and retries used for a provider's HTTP calls"""
+
+    pool_size: int = 10
+    connect_timeout: float = 3.05
+    read_timeout: float = 10.0
+    retries: int = 2
+    backoff_factor: float = 0.3
+
+    def timeout(self, uri: Optional[Uri] = None) -> Tuple[float, float]:
+        """(connect, read) timeout tuple, the uri may override the read timeout"""
+        read_timeout = uri.timeout if uri and uri.timeout else self.read_timeout
+        return (self.connect_timeout, read_timeout)
+
+
+@dataclass(frozen=True)
+class CircuitBreakerConfig:
+    """When a provider's calls (over the last 'window' ones) fail or are slow
+    too often, calls to it fail fast for 'open_seconds', then one call probes
+    if it recovered. Read timeouts adapt to the provider's p99 latency"""
+
+    enabled: bool = True
+    window: int = 50
+    min_calls: int = 10
+    error_rate: float = 0.5
+    slow_call_seconds: float = 5.0
+    slow_call_rate: float = 0.5
+    open_seconds: float = 30.0
+    adaptive_timeout: bool = True
+    timeout_multiplier: float = 3.0
+    min_timeout: float = 1.0
+
+
+@dataclass(frozen=True)
+class OidcConfig:
+    """OpenID Connect settings, when set the user info is read from the
+    id_token verified against the provider's published keys"""
+
+    discovery_uri: str
+    cache_ttl: int = 3600
+    leeway: int = 60
+
+
+@dataclass(frozen=True)
 class Provider:
     name: str
     client_id: str
@@ -49,6 +110,55 @@ class Provider:
     auth_uri: Optional[Uri] = None
     client_secret: Optional[str] = None
     redirect_uri: Optional[str] = None
+    http: Optional[HttpConfig] = None
+    oidc: Optional[OidcConfig] = None
+    circuit_breaker: Optional[CircuitBreakerConfig] = None
+    avatar_refresh_interval: Optional[int] = None
+    pkce: bool = True
+    # Compiled from the fields above, requests only merge their own values
+    auth_url: Optional[str] = field(init=False, repr=False, compare=False)
+    tokens_data: Mapping = field(init=False, repr=False, compare=False)
+    user_info_query: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.http is None:
+            object.__setattr__(self, "http", HttpConfig())
+        if self.circuit_breaker is None:
+            object.__setattr__(self, "circuit_breaker", CircuitBreakerConfig())
+        self._compile()
+
+    def _compile(self) -> None:
+        auth_url = None
+        if self.auth_uri:
+            auth_url = add_query(
+                self.auth_uri.path,
+                {"client_id": self.client_id, **self.auth_uri.extra_params},
+            )
+        tokens_data = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": self.tokens_uri.extra_params.get("grant_type"),
+        }
+        object.__setattr__(self, "auth_url", auth_url)
+        object.__setattr__(self, "tokens_data", MappingProxyType(tokens_data))
+        object.__setattr__(
+            self, "user_info_query", urlencode(self.user_info_uri.extra_params)
+        )
+
+    def authorization_url(self, params: dict) -> str:
+        """Authorization url with the request 'params' added"""
+
+        if not self.auth_url:
+            raise ExternalAuthError(
+                f"{self.name} has no auth_uri in configuration", "config"
+            )
+        return add_query(self.auth_url, params)
+
+    def user_info_url(self, access_token: str) -> str:
+        """User info url carrying the 'access_token'"""
+
+        url = add_query(self.user_info_uri.path, {"access_token": access_token})
+        return f"{url}&{self.user_info_query}" if self.user_info_query else url
 
 
 @dataclass
@@ -56,15 +166,60 @@ class Context:
     payload: dict
     provider: Provider
     data: Optional[dict] = None
+    # time.monotonic() by which the login must be done
+    deadline: Optional[float] = None
+
+    def with_data(self, **data) -> "Context":
+        """Copy of this context with 'data' merged in"""
+        return replace(self, data={**(self.data or {}), **data})
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the deadline, None without one"""
+        return remaining(self.deadline)
 
 
 class ExternalAuthError(Exception):
-    def __init__(self, value) -> None:
+    def __init__(self, value, cause: str = "error") -> None:
         self.value = value
+        # short machine readable reason, i.e. for metrics labels
+        self.cause = cause
 
     def __str__(self) -> str:
         return f"External Authentication Error: {self.value}"
 
 
+class ProviderUnavailableError(ExternalAuthError):
+    """The provider's circuit breaker is open, it wasn't called"""
+
+    def __init__(self, provider: str) -> None:
+        super().__init__(
+            f"{provider} is unavailable, try again later", "provider_unavailable"
+        )
+
+
+class RateLimitedError(ExternalAuthError):
+    """Too many requests from a client or for a provider"""
+
+    def __init__(self, scope: str) -> None:
+        super().__init__(
+            f"Too many requests, try again later ({scope})", "rate_limited"
+        )
+
+
+class DeadlineExceededError(ExternalAuthError):
+    """The login ran out of its time budget"""
+
+    def __init__(self) -> None:
+        super().__init__("Login took too long, try again", "deadline_exceeded")
+
+
+class InvalidAvatarError(ExternalAuthError):
+    """The avatar isn't an accepted image or is too big, retrying won't help"""
+
+    def __init__(self, uri: str, reason: str) -> None:
+        super().__init__(f"Invalid avatar at {uri}: {reason}", "avatar_invalid")
+        self.reason = reason
+
+
 class AuthWarning(Warning):
     pass
@@ -0,0 +1,260 @@
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import breaker, metrics
+from .breaker import CircuitBreaker
+from .external_auth_types import (
+    DeadlineExceededError,
+    HttpConfig,
+    Provider,
+    Uri,
+    remaining,
+)
+
+# Only idempotent calls are retried, the token exchange (POST) is never
+# replayed because an authorization code can be used only once
+RETRY_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+DEFAULT_CLIENT = "default"
+
+
+@dataclass
+class PoolStats:
+    requests: int = 0
+    errors: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+    connections: int = 0
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter keeping usage counters of its connection pool"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        self._stats = PoolStats()
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def max_retries(self) -> Retry:
+        return getattr(self._local, "retry", None) or self._max_retries
+
+    @max_retries.setter
+    def max_retries(self, retry: Retry) -> None:
+        self._max_retries = retry
+
+    @contextmanager
+    def retrying(self, retry: Optional[Retry]):
+        """Calls of this thread within the block use 'retry' (when set)"""
+
+        self._local.retry = retry
+        try:
+            yield
+        finally:
+            self._local.retry = None
+
+    def send(self, request, **kwargs):
+        with self._stats_lock:
+            self._stats.requests += 1
+            self._stats.in_flight += 1
+            self._stats.max_in_flight = max(
+                self._stats.max_in_flight, self._stats.in_flight
+            )
+        try:
+            return super().send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            with self._stats_lock:
+                self._stats.errors += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self._stats.in_flight -= 1
+
+    def stats(self) -> PoolStats:
+        """Snapshot of the counters, 'connections' is the number of
+        connections opened so far by all pools of this adapter"""
+
+        pools = self.poolmanager.pools
+        connections = 0
+        for key in pools.keys():
+            try:
+                connections += pools[key].num_connections
+            except KeyError:
+                # pool evicted while iterating
+                continue
+
+        with self._stats_lock:
+            return PoolStats(**{**asdict(self._stats), "connections": connections})
+
+
+def build_retry(config: HttpConfig, total: int) -> Retry:
+    return Retry(
+        total=total,
+        backoff_factor=config.backoff_factor,
+        allowed_methods=RETRY_METHODS,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+
+
+def build_session(config: HttpConfig) -> Tuple[requests.Session, CountingAdapter]:
+    adapter = CountingAdapter(
+        pool_connections=config.pool_size,
+        pool_maxsize=config.pool_size,
+        max_retries=build_retry(config, config.retries),
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session, adapter
+
+
+_clients: Dict[str, Tuple[HttpConfig, requests.Session, CountingAdapter]] = {}
+_clients_lock = threading.Lock()
+
+
+def get_session(
+    name: str = DEFAULT_CLIENT, config: Optional[HttpConfig] = None
+) -> requests.Session:
+    """Process wide pooled session for 'name', the session is rebuilt
+    when the configuration for 'name' changes"""
+
+    config = config or HttpConfig()
+    client = _clients.get(name)
+    if client and client[0] == config:
+        return client[1]
+
+    with _clients_lock:
+        client = _clients.get(name)
+        if client and client[0] == config:
+            return client[1]
+        if client:
+            client[1].close()
+
+        session, adapter = build_session(config)
+        _clients[name] = (config, session, adapter)
+        return session
+
+
+def get_circuit_breaker(provider: Optional[Provider]) -> Optional[CircuitBreaker]:
+    if provider and provider.circuit_breaker.enabled:
+        return breaker.get_breaker(provider)
+    return None
+
+
+def timeout(
+    config: HttpConfig,
+    uri: Optional[Uri],
+    circuit_breaker: Optional[CircuitBreaker],
+    deadline: Optional[float] = None,
+    attempts: int = 1,
+) -> Tuple[float, float]:
+    """(connect, read) timeout, the read one adapted by the circuit breaker,
+    both cut to the time left until 'deadline' (time.monotonic()). With
+    several 'attempts' each one's timeouts are cut to its share of it"""
+
+    connect_timeout, read_timeout = config.timeout(uri)
+    if circuit_breaker:
+        read_timeout = circuit_breaker.read_timeout(read_timeout)
+    left = remaining(deadline)
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceededError()
+        connect_timeout, read_timeout = min(connect_timeout, left), min(
+            read_timeout, left
+        )
+        share = left / attempts
+        if attempts > 1 and connect_timeout + read_timeout > share:
+            scale = share / (connect_timeout + read_timeout)
+            connect_timeout, read_timeout = (
+                connect_timeout * scale,
+                read_timeout * scale,
+            )
+    return connect_timeout, read_timeout
+
+
+@contextmanager
+def measure(name: str, method: str, circuit_breaker: Optional[CircuitBreaker]):
+    """Fail fast if the circuit breaker is open, then record the call's
+    outcome in the breaker and metrics. The block sets call["status"]"""
+
+    if circuit_breaker:
+        circuit_breaker.before_call()
+
+    call = {"status": "error"}
+    start = time.perf_counter()
+    try:
+        yield call
+    finally:
+        seconds = time.perf_counter() - start
+        status = call["status"]
+        metrics.record_http(name, method, status, seconds)
+        if circuit_breaker:
+            healthy = isinstance(status, int) and status < 500 and status != 429
+            circuit_breaker.record(healthy, seconds)
+
+
+def deadline_attempts(
+    config: HttpConfig, method: str, attempt: float, deadline: Optional[float]
+) -> int:
+    """Attempts of a request, retries included, planned within a deadline:
+    as many as fit if each takes 'attempt' (seconds). Retried methods get
+    at least one retry, their timeouts cut to fit (see 'timeout')"""
+
+    left = remaining(deadline)
+    if left is None or method not in RETRY_METHODS or not config.retries:
+        return 1
+    fit = int(left // attempt) if attempt else 1
+    return max(min(config.retries + 1, fit), 2)
+
+
+def request(
+    method: str,
+    provider: Optional[Provider],
+    url: str,
+    uri: Optional[Uri] = None,
+    deadline: Optional[float] = None,
+    **kwargs,
+) -> requests.Response:
+    """Make a request through the provider's pooled session
+    using the provider's configured timeouts, within 'deadline'"""
+
+    name = provider.name if provider else DEFAULT_CLIENT
+    config = provider.http if provider else HttpConfig()
+    session = get_session(name, config)
+    circuit_breaker = get_circuit_breaker(provider)
+    attempts = deadline_attempts(
+        config, method, sum(timeout(config, uri, circuit_breaker)), deadline
+    )
+    connect_timeout, read_timeout = timeout(
+        config, uri, circuit_breaker, deadline, attempts
+    )
+    kwargs.setdefault("timeout", (connect_timeout, read_timeout))
+    # None keeps the session's retries
+    retry = None if deadline is None else build_retry(config, attempts - 1)
+
+    with measure(name, method, circuit_breaker) as call:
+        with session.get_adapter(url).retrying(retry):
+            response = session.request(method, url, **kwargs)
+        call["status"] = response.status_code
+        return response
+
+
+def pool_stats() -> Dict[str, PoolStats]:
+    """Connection pool usage counters by client name"""
+    return {name: adapter.stats() for name, (_, _, adapter) in list(_clients.items())}
+
+
+def close_all() -> None:
+    with _clients_lock:
+        for _, session, _ in _clients.values():
+            session.close()
+        _clients.clear()
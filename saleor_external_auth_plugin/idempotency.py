@@ -0,0 +1,84 @@
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+from .conf import get_setting
+from .external_auth_types import Context, ExternalAccessTokens
+from .state import get_state_store
+
+_in_flight: Dict[str, Future] = {}
+_in_flight_lock = threading.Lock()
+
+
+def exchange_key(context: Context, client: Optional[str]) -> Optional[str]:
+    """Key of the (provider, code, state, client) exchange, None without a
+    code. The state is part of it so a code resubmitted with another state
+    goes through check_state instead of getting the issued tokens, and the
+    client so only the caller that submitted it gets them again"""
+
+    code, state = context.payload.get("code"), context.payload.get("state")
+    if not isinstance(code, str) or not code:
+        return None
+    exchange = f"{context.provider.name}\0{code}\0{state}\0{client}"
+    return f"tokens:{hashlib.sha256(exchange.encode()).hexdigest()}"
+
+
+def single_flight(key: str, fn: Callable[[], ExternalAccessTokens]):
+    """Run 'fn' once for all the concurrent callers with the same 'key',
+    they all get its result (or exception)"""
+
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = Future()
+    if not leader:
+        return future.result()
+
+    try:
+        result = fn()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+def exchange(
+    context: Context,
+    tokens: Callable[[Context], ExternalAccessTokens],
+    client: Optional[str],
+) -> ExternalAccessTokens:
+    """Tokens of the context's authorization code. Concurrent submissions
+    of a code and state from the same 'client' (IP) wait for one exchange
+    instead of calling the provider with an already used code. Repeated
+    ones get the tokens already issued to that client for TOKENS_CACHE_TTL
+    seconds, unless it's unknown"""
+
+    key = exchange_key(context, client)
+    if not key:
+        return tokens(context)
+
+    ttl = get_setting("TOKENS_CACHE_TTL")
+    if not ttl or client is None:
+        return single_flight(key, lambda: tokens(context))
+
+    store = get_state_store()
+    issued = store.get(key)
+    if issued:
+        return issued["tokens"]
+
+    def run() -> ExternalAccessTokens:
+        issued = store.get(key)
+        if issued:
+            return issued["tokens"]
+        result = tokens(context)
+        store.put(key, {"tokens": result}, ttl)
+        return result
+
+    return single_flight(key, run)
@@ -0,0 +1,214 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from django.core.cache import caches
+from django.db import close_old_connections
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+def write(last_logins: Dict[int, datetime], batch_size: int) -> None:
+    """Set the last_login of each user id with bulk updates of
+    'batch_size' users"""
+
+    from saleor.account.models import User
+
+    if last_logins:
+        User.objects.bulk_update(
+            [User(pk=pk, last_login=at) for pk, at in last_logins.items()],
+            ["last_login"],
+            batch_size=batch_size,
+        )
+
+
+class LastLoginBuffer:
+    """Collects the last_login of returning users, written in bulk by a
+    background thread when 'flush_size' are pending or the oldest has
+    waited 'max_staleness' seconds, and when the process exits"""
+
+    def __init__(self, flush_size: int, max_staleness: float) -> None:
+        self.flush_size = flush_size
+        self.max_staleness = max_staleness
+        self._timer: Optional[threading.Thread] = None
+        self._timer_lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def add(self, user_id: int, at: datetime) -> None:
+        raise NotImplementedError
+
+    def added(self, pending: int, oldest_age: float) -> None:
+        self.start_timer()
+        if pending >= self.flush_size or oldest_age >= self.max_staleness:
+            # written by the timer thread, off the login's request
+            self._wake.set()
+
+    def flush(self) -> None:
+        raise NotImplementedError
+
+    def flush_in_background(self) -> None:
+        """'flush' from a thread outside of Django's request cycle, with a
+        usable database connection"""
+
+        close_old_connections()
+        try:
+            self.flush()
+        except Exception:
+            # kept in the buffer for the next flush
+            logger.exception("Could not write buffered last logins")
+        finally:
+            close_old_connections()
+
+    def start_timer(self) -> None:
+        """Flush every 'max_staleness' seconds, or when woken up, from a
+        daemon thread of this process started on first use (i.e. after a fork)"""
+
+        if self._timer and self._timer.is_alive():
+            return
+        with self._timer_lock:
+            if self._timer and self._timer.is_alive():
+                return
+
+            def run() -> None:
+                while True:
+                    self._wake.wait(self.max_staleness)
+                    self._wake.clear()
+                    self.flush_in_background()
+
+            self._timer = threading.Thread(target=run, daemon=True)
+            self._timer.start()
+
+
+class MemoryLastLoginBuffer(LastLoginBuffer):
+    """Per process buffer, lost if the process is killed"""
+
+    def __init__(self, flush_size: int, max_staleness: float) -> None:
+        super().__init__(flush_size, max_staleness)
+        self._last_logins: Dict[int, datetime] = {}
+        self._since = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, user_id: int, at: datetime) -> None:
+        with self._lock:
+            if not self._last_logins:
+                self._since = time.monotonic()
+            self._last_logins[user_id] = at
+        self.added(self.pending(), self.oldest_age())
+
+    def pending(self) -> int:
+        return len(self._last_logins)
+
+    def oldest_age(self) -> float:
+        return time.monotonic() - self._since if self._last_logins else 0.0
+
+    def flush(self) -> None:
+        with self._lock:
+            last_logins, self._last_logins = self._last_logins, {}
+            since = self._since
+        try:
+            write(last_logins, self.flush_size)
+        except Exception:
+            with self._lock:
+                self._since = min(since, self._since) if self._last_logins else since
+                for user_id, at in last_logins.items():
+                    self._last_logins[user_id] = max(
+                        at, self._last_logins.get(user_id, at)
+                    )
+            raise
+
+
+class CacheLastLoginBuffer(LastLoginBuffer):
+    """Buffer in a Django cache shared by all processes: logins are numbered
+    by an atomic counter and whoever holds the flush lock writes those after
+    the last flushed number. Needs a cache with atomic incr and add
+    (i.e. redis or memcached). A login numbered but not stored yet when a
+    flush reads it is skipped, its user's next login will be written"""
+
+    prefix = "external_auth:last_login:"
+
+    def __init__(self, alias: str, flush_size: int, max_staleness: float) -> None:
+        super().__init__(flush_size, max_staleness)
+        self.cache = caches[alias]
+
+    def key(self, name) -> str:
+        return f"{self.prefix}{name}"
+
+    def next_number(self) -> int:
+        try:
+            return self.cache.incr(self.key("seq"))
+        except ValueError:
+            # evicted (or never set): numbering restarts after the flushed
+            # ones, or those below them would be taken as already written
+            flushed = self.cache.get(self.key("flushed"), 0)
+            self.cache.add(self.key("seq"), flushed, None)
+            return self.cache.incr(self.key("seq"))
+
+    def add(self, user_id: int, at: datetime) -> None:
+        number = self.next_number()
+        # kept long enough for a late flush, not forever
+        self.cache.set(self.key(number), (user_id, at), self.max_staleness * 10)
+        state = self.cache.get_many([self.key("flushed"), self.key("since")])
+        since = state.get(self.key("since"))
+        if since is None:
+            self.cache.add(self.key("since"), time.time(), None)
+        self.added(
+            number - state.get(self.key("flushed"), 0),
+            time.time() - since if since else 0.0,
+        )
+
+    def flush(self) -> None:
+        if not self.cache.add(self.key("lock"), 1, int(self.max_staleness) + 1):
+            return
+        try:
+            self.cache.delete(self.key("since"))
+            last = self.cache.get(self.key("seq"), 0)
+            flushed = self.cache.get(self.key("flushed"), 0)
+            # older ones expired already, unless 'flushed' was evicted
+            first = max(flushed + 1, last - self.flush_size * 10 + 1)
+            keys = [self.key(n) for n in range(first, last + 1)]
+            last_logins: Dict[int, datetime] = {}
+            for user_id, at in self.cache.get_many(keys).values():
+                last_logins[user_id] = max(at, last_logins.get(user_id, at))
+            try:
+                write(last_logins, self.flush_size)
+            except Exception:
+                # pending ones are left for the next flush
+                self.cache.add(self.key("since"), time.time(), None)
+                raise
+            self.cache.set(self.key("flushed"), last, None)
+            self.cache.delete_many(keys)
+        finally:
+            self.cache.delete(self.key("lock"))
+
+
+_buffer: Optional[LastLoginBuffer] = None
+_buffer_loaded = False
+_buffer_lock = threading.Lock()
+
+
+def get_buffer() -> Optional[LastLoginBuffer]:
+    """The buffer of the LAST_LOGIN_BUFFER setting ("memory" or "cache"),
+    None when last_login is written by each login"""
+
+    global _buffer, _buffer_loaded
+    if not _buffer_loaded:
+        with _buffer_lock:
+            if not _buffer_loaded:
+                kind = get_setting("LAST_LOGIN_BUFFER")
+                size = get_setting("LAST_LOGIN_FLUSH_SIZE")
+                staleness = get_setting("LAST_LOGIN_MAX_STALENESS")
+                if kind == "memory":
+                    _buffer = MemoryLastLoginBuffer(size, staleness)
+                elif kind == "cache":
+                    _buffer = CacheLastLoginBuffer(
+                        get_setting("LAST_LOGIN_CACHE_ALIAS"), size, staleness
+                    )
+                if _buffer:
+                    atexit.register(_buffer.flush_in_background)
+                _buffer_loaded = True
+    return _buffer
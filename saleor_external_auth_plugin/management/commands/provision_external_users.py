@@ -0,0 +1,17 @@
+import argparse
+import json
+
+from django.core.management.base import BaseCommand
+
+from ... import provisioning
+
+
+class Command(BaseCommand):
+    help = provisioning.__doc__.splitlines()[0]
+
+    def add_arguments(self, parser) -> None:
+        provisioning.add_arguments(parser)
+
+    def handle(self, **options) -> None:
+        args = argparse.Namespace(**options)
+        self.stdout.write(json.dumps(provisioning.run(args).__dict__))
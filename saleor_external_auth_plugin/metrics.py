@@ -0,0 +1,211 @@
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from django.utils.module_loading import import_string
+
+from . import utils as u
+from .conf import get_setting
+from .external_auth_types import ExternalAuthError
+
+Tags = Dict[str, str]
+
+STAGE_SECONDS = "external_auth_stage_seconds"
+STAGE_ERRORS = "external_auth_stage_errors"
+HTTP_SECONDS = "external_auth_http_seconds"
+
+
+class MetricsSink:
+    """Receives the plugin's measurements, subclasses send them to a backend"""
+
+    def timing(self, name: str, seconds: float, tags: Tags) -> None:
+        pass
+
+    def increment(self, name: str, tags: Tags) -> None:
+        pass
+
+    def gauge(self, name: str, value: float, tags: Tags) -> None:
+        pass
+
+
+class PrometheusSink(MetricsSink):
+    """Histograms, counters and gauges in a prometheus_client registry"""
+
+    def __init__(self, registry=None) -> None:
+        import prometheus_client
+
+        self._prometheus = prometheus_client
+        self._registry = registry or prometheus_client.REGISTRY
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _metric(self, kind: str, name: str, tags: Tags):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name) or getattr(self._prometheus, kind)(
+                    name, name, sorted(tags), registry=self._registry
+                )
+                self._metrics[name] = metric
+        return metric.labels(**tags)
+
+    def timing(self, name: str, seconds: float, tags: Tags) -> None:
+        self._metric("Histogram", name, tags).observe(seconds)
+
+    def increment(self, name: str, tags: Tags) -> None:
+        self._metric("Counter", name, tags).inc()
+
+    def gauge(self, name: str, value: float, tags: Tags) -> None:
+        self._metric("Gauge", name, tags).set(value)
+
+
+class StatsdSink(MetricsSink):
+    """Plain statsd, tags are appended to the metric names"""
+
+    def __init__(self, host: str = "localhost", port: int = 8125) -> None:
+        import statsd
+
+        self._client = statsd.StatsClient(host, port)
+
+    @staticmethod
+    def _name(name: str, tags: Tags) -> str:
+        parts = [name, *(tags[k] for k in sorted(tags))]
+        return ".".join(re.sub(r"[^\w-]", "_", str(part)) for part in parts)
+
+    def timing(self, name: str, seconds: float, tags: Tags) -> None:
+        self._client.timing(self._name(name, tags), seconds * 1000)
+
+    def increment(self, name: str, tags: Tags) -> None:
+        self._client.incr(self._name(name, tags))
+
+    def gauge(self, name: str, value: float, tags: Tags) -> None:
+        self._client.gauge(self._name(name, tags), value)
+
+
+class OpenTelemetrySink(MetricsSink):
+    """Timings become spans (ending now) and histograms, the rest counters
+    and gauges, all through the globally configured providers"""
+
+    def __init__(self) -> None:
+        from opentelemetry import metrics, trace
+
+        self._tracer = trace.get_tracer(__name__)
+        self._meter = metrics.get_meter(__name__)
+        self._instruments: Dict[str, Any] = {}
+        self._gauges: Dict[str, Dict[tuple, float]] = {}
+        self._lock = threading.Lock()
+
+    def _instrument(self, create: Callable, name: str, *args):
+        if name not in self._instruments:
+            with self._lock:
+                if name not in self._instruments:
+                    self._instruments[name] = create(name, *args)
+        return self._instruments[name]
+
+    def timing(self, name: str, seconds: float, tags: Tags) -> None:
+        end = time.time_ns()
+        span = self._tracer.start_span(
+            tags.get("stage", name), start_time=end - int(seconds * 1e9)
+        )
+        span.set_attributes(tags)
+        span.end(end_time=end)
+        self._instrument(self._meter.create_histogram, name, "s").record(seconds, tags)
+
+    def increment(self, name: str, tags: Tags) -> None:
+        self._instrument(self._meter.create_counter, name).add(1, tags)
+
+    def gauge(self, name: str, value: float, tags: Tags) -> None:
+        from opentelemetry.metrics import Observation
+
+        values = self._gauges.setdefault(name, {})
+        values[tuple(sorted(tags.items()))] = value
+
+        def observe(options):
+            return [Observation(v, dict(k)) for k, v in list(values.items())]
+
+        self._instrument(self._meter.create_observable_gauge, name, [observe])
+
+
+_sink: Optional[MetricsSink] = None
+_sink_loaded = False
+
+
+def set_sink(sink: Optional[MetricsSink]) -> None:
+    """Use 'sink' for all measurements, None disables them"""
+
+    global _sink, _sink_loaded
+    _sink, _sink_loaded = sink, True
+
+
+def get_sink() -> Optional[MetricsSink]:
+    """The sink built by the METRICS_SINK setting (a dotted path to a
+    MetricsSink factory) or set by set_sink, None when not configured"""
+
+    if not _sink_loaded:
+        path = get_setting("METRICS_SINK")
+        set_sink(import_string(path)() if path else None)
+    return _sink
+
+
+def error_cause(error: Exception) -> str:
+    return error.cause if isinstance(error, ExternalAuthError) else type(error).__name__
+
+
+def instrument_stage(
+    pipeline: str, stage: Callable[[Any], Any]
+) -> Callable[[Any], Any]:
+    """Record the latency and errors of a pipeline stage taking a Context"""
+
+    name = getattr(stage, "__name__", type(stage).__name__)
+
+    def record(sink: MetricsSink, tags: Tags, start: float, error=None) -> None:
+        sink.timing(STAGE_SECONDS, time.perf_counter() - start, tags)
+        if error is not None:
+            sink.increment(STAGE_ERRORS, {**tags, "cause": error_cause(error)})
+
+    def run(context):
+        sink = get_sink()
+        if not sink:
+            return stage(context)
+        provider = getattr(getattr(context, "provider", None), "name", "unknown")
+        tags = {"pipeline": pipeline, "stage": name, "provider": provider}
+        start = time.perf_counter()
+        try:
+            result = stage(context)
+        except Exception as e:
+            record(sink, tags, start, e)
+            raise
+        record(sink, tags, start)
+        return result
+
+    run.__name__ = name
+    # keeps the pipeline.optional mark
+    run.optional = getattr(stage, "optional", False)
+    return run
+
+
+def instrument(
+    pipeline: str, stages: Iterable[Callable[[Any], Any]], pipe=u.pipe
+) -> Callable[[Any], Any]:
+    """Pipe of 'stages' recording each one's metrics, the plain pipe
+    is used while no sink is configured"""
+
+    stages = list(stages)
+    plain = pipe(*stages)
+    measured = pipe(*[instrument_stage(pipeline, stage) for stage in stages])
+
+    def run(context):
+        return measured(context) if get_sink() else plain(context)
+
+    return run
+
+
+def record_http(provider: str, method: str, status: Any, seconds: float) -> None:
+    sink = get_sink()
+    if sink:
+        sink.timing(
+            HTTP_SECONDS,
+            seconds,
+            {"provider": provider, "method": method, "status": str(status)},
+        )
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db import models
+
+
+class ExternalIdentity(models.Model):
+    """A user's account at a provider, identified by the provider's
+    subject (OIDC 'sub', or 'id') that unlike the email never changes"""
+
+    provider = models.CharField(max_length=64)
+    subject = models.CharField(max_length=255)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="external_identities",
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["provider", "subject"],
+                name="external_identity_provider_subject",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.provider}:{self.subject}"
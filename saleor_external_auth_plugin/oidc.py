@@ -0,0 +1,134 @@
+import secrets
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import jwt
+import requests
+
+from . import http_client
+from .external_auth_types import ExternalAuthError, Provider
+
+# Registered claims are not user info, dropping them also keeps urls
+# like "iss" out of the avatar lookup
+REGISTERED_CLAIMS = frozenset(
+    ["iss", "aud", "exp", "iat", "nbf", "azp", "at_hash", "c_hash", "nonce", "jti"]
+)
+# A token signed with an unknown key id forces a keys refresh, but no more
+# often than this so forged key ids can't hammer the provider
+MIN_JWKS_REFRESH_INTERVAL = 60
+
+
+class TTLCache:
+    """Thread safe in memory cache with expiring entries"""
+
+    def __init__(self) -> None:
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, ttl: int, load: Callable[[], Any], force=False) -> Any:
+        entry = self._entries.get(key)
+        if entry and not force and entry[0] > time.monotonic():
+            return entry[1]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not force and entry[0] > time.monotonic():
+                return entry[1]
+            value = load()
+            self._entries[key] = (time.monotonic() + ttl, value)
+            return value
+
+    def age(self, key: str, ttl: int) -> Optional[float]:
+        entry = self._entries.get(key)
+        return ttl - (entry[0] - time.monotonic()) if entry else None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = TTLCache()
+
+
+def fetch_json(provider: Provider, uri: str) -> dict:
+    try:
+        response = http_client.request("GET", provider, uri)
+        response.raise_for_status()
+        return response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        raise ExternalAuthError(
+            f"Could not load OpenID configuration from {uri}", "oidc_unavailable"
+        )
+
+
+def get_discovery(provider: Provider) -> dict:
+    """Provider's OpenID discovery document"""
+
+    uri = provider.oidc.discovery_uri
+    return _cache.get(uri, provider.oidc.cache_ttl, lambda: fetch_json(provider, uri))
+
+
+def get_signing_key(provider: Provider, id_token: str) -> jwt.PyJWK:
+    """Key that signed 'id_token', refreshing the cached keys
+    once if the provider rotated them"""
+
+    try:
+        kid = jwt.get_unverified_header(id_token).get("kid")
+    except jwt.PyJWTError:
+        raise ExternalAuthError("Invalid id_token", "invalid_id_token")
+
+    uri = get_discovery(provider)["jwks_uri"]
+    ttl = provider.oidc.cache_ttl
+
+    def load() -> Dict[str, jwt.PyJWK]:
+        keys = jwt.PyJWKSet.from_dict(fetch_json(provider, uri)).keys
+        return {key.key_id: key for key in keys}
+
+    keys = _cache.get(uri, ttl, load)
+    if kid not in keys and _cache.age(uri, ttl) >= MIN_JWKS_REFRESH_INTERVAL:
+        keys = _cache.get(uri, ttl, load, force=True)
+
+    if kid not in keys:
+        raise ExternalAuthError(
+            "id_token signed with an unknown key", "invalid_id_token"
+        )
+
+    return keys[kid]
+
+
+def get_user_info(provider: Provider, id_token: str, nonce: Optional[str]) -> dict:
+    """User info from the claims of a verified id_token, that must carry
+    the 'nonce' sent in the authentication url"""
+
+    discovery = get_discovery(provider)
+    key = get_signing_key(provider, id_token)
+    try:
+        claims = jwt.decode(
+            id_token,
+            key=key.key,
+            algorithms=[key.algorithm_name],
+            audience=provider.client_id,
+            leeway=provider.oidc.leeway,
+            options={"require": ["iss", "aud", "exp"]},
+        )
+    except jwt.PyJWTError as e:
+        raise ExternalAuthError(f"Invalid id_token: {e}", "invalid_id_token")
+
+    # some providers (i.e. Google) may leave the scheme out of the issuer
+    issuer = discovery.get("issuer", "")
+    if claims["iss"] not in (issuer, issuer.split("://")[-1]):
+        raise ExternalAuthError("Invalid id_token: invalid issuer", "invalid_id_token")
+    if nonce and not secrets.compare_digest(str(claims.get("nonce")), nonce):
+        raise ExternalAuthError("Invalid id_token: invalid nonce", "invalid_id_token")
+
+    return {k: v for k, v in claims.items() if k not in REGISTERED_CLAIMS}
+
+
+def can_skip_user_info(provider: Provider, credentials: dict) -> bool:
+    """If the user info can be read from the credentials' id_token"""
+    return bool(provider.oidc and credentials.get("id_token"))
+
+
+def clear_cache() -> None:
+    _cache.clear()
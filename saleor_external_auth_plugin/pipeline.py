@@ -0,0 +1,73 @@
+import time
+from dataclasses import replace
+from typing import Any, Callable, Optional
+
+from .conf import get_setting
+from .external_auth_types import (
+    Context,
+    DeadlineExceededError,
+    ExternalAuthError,
+    remaining as time_left,
+)
+
+Stage = Callable[[Any], Any]
+
+
+def optional(stage: Stage) -> Stage:
+    """Mark 'stage' as one the login can do without when short of time"""
+
+    stage.optional = True
+    return stage
+
+
+def start(context: Context) -> Context:
+    """'context' with a deadline LOGIN_BUDGET seconds from now,
+    unless it already has one"""
+
+    budget = get_setting("LOGIN_BUDGET")
+    if context.deadline is not None or budget is None:
+        return context
+    return replace(context, deadline=time.monotonic() + budget)
+
+
+def should_run(stage: Stage, deadline: Optional[float]) -> bool:
+    """Raise if the deadline passed, False for an optional stage that
+    would leave too little time"""
+
+    left = time_left(deadline)
+    if left is None:
+        return True
+    if left <= 0:
+        raise DeadlineExceededError()
+    return not getattr(stage, "optional", False) or left >= get_setting(
+        "OPTIONAL_STAGE_MIN_BUDGET"
+    )
+
+
+def stage_error(error: ExternalAuthError, deadline: Optional[float]) -> Exception:
+    """Failures once the deadline passed are reported as such, they are
+    most likely timeouts cut short by it"""
+
+    left = time_left(deadline)
+    if left is not None and left <= 0 and error.cause != "deadline_exceeded":
+        exceeded = DeadlineExceededError()
+        exceeded.__cause__ = error
+        return exceeded
+    return error
+
+
+def budget_pipe(*stages: Stage) -> Callable[[Context], Any]:
+    """Like 'utils.pipe' for stages taking a Context, within its deadline"""
+
+    def run(context: Context) -> Any:
+        value = context = start(context)
+        for stage in stages:
+            if not should_run(stage, context.deadline):
+                continue
+            try:
+                value = stage(value)
+            except ExternalAuthError as e:
+                raise stage_error(e, context.deadline)
+        return value
+
+    return run
@@ -1,17 +1,23 @@
-from typing import TYPE_CHECKING, Optional
+from functools import cached_property
+from typing import TYPE_CHECKING, Mapping, Optional
 
 from django.core.handlers.wsgi import WSGIRequest
 from saleor.plugins.base_plugin import BasePlugin
 
-from . import constants, utils
-from . import external_auth as ea
+from . import constants
 
 from .external_auth_types import (
     ConfigurationTypeField,
     ExternalAccessTokens,
+    ExternalAuthError,
     PluginConfigurationType,
+    Provider,
 )
 
+# The login modules (requests, yaml, JWT, Saleor's avatar handling...) are
+# imported by the first call using them, or by warm_up, so loading the
+# plugin (active or not) in every worker and command stays cheap
+
 if TYPE_CHECKING:
     # flake8: noqa
     from channel.models import Channel
@@ -49,6 +55,14 @@ class ExternalAuthPlugin(BasePlugin):
         """Check if given plugin_id matches with the PLUGIN_ID of this plugin."""
         return cls.PLUGIN_ID == plugin_id
 
+    @classmethod
+    def save_plugin_configuration(cls, plugin_configuration, cleaned_data):
+        from . import external_auth as ea
+
+        # drop parsed configurations, the new one is parsed on next use
+        ea.clear_providers_cache()
+        return super().save_plugin_configuration(plugin_configuration, cleaned_data)
+
     def __init__(
         self,
         *,
@@ -57,38 +71,67 @@ class ExternalAuthPlugin(BasePlugin):
         channel: Optional["Channel"] = None,
     ):
         self.configuration = self.get_plugin_configuration(configuration)
-        self.providers_config = ea.get_providers_from_config(self.configuration)
         self.active = active
         self.channel = channel
 
+    @cached_property
+    def providers_config(self) -> Mapping[str, Provider]:
+        """Parsed on first use, inactive plugins never parse it"""
+
+        from . import external_auth as ea
+
+        return ea.get_providers_from_config(self.configuration)
+
     def __str__(self):
         return self.PLUGIN_NAME
 
     def external_authentication_url(
         self, payload: dict, request: WSGIRequest, **kwargs
     ) -> dict:
-        context = ea.get_context(self.providers_config)(payload)
-        provider = context.provider
-        auth_uri = utils.make_uri(provider.auth_uri.path)
+        from . import external_auth as ea
+
+        names = ea.requested_providers(self.providers_config, payload)
+        if names is not None:
+            return {
+                "authorizationUrls": ea.authorization_urls(
+                    self.providers_config, names, payload
+                )
+            }
 
+        context = ea.get_context(self.providers_config)(payload)
         return {
-            "authorizationUrl": auth_uri(
-                {
-                    "client_id": provider.client_id,
-                    "state": ea.get_state(provider.client_id),
-                    "redirect_uri": payload.get("redirectUri", provider.redirect_uri),
-                    **provider.auth_uri.extra_params,
-                }
-            )
+            "authorizationUrl": ea.authorization_url(context, ea.get_state(context))
         }
 
     def external_obtain_access_tokens(
         self, payload: dict, request: WSGIRequest, previous_value: ExternalAccessTokens
     ) -> ExternalAccessTokens:
-        context = ea.get_context(self.providers_config)(payload)
-        tokens = ea.tokens(context)
+        from . import external_auth as ea
+        from . import idempotency, profiling, ratelimit
+
+        limiter = ratelimit.get_rate_limiter()
+        limiter.check_payload(payload)
+        client = ratelimit.client_ip(request)
+        limiter.check_client(client)
+        try:
+            context = ea.get_context(self.providers_config)(payload)
+            pipeline = ea.tokens
+            profiler = profiling.get_profiler()
+            if profiler and profiler.sample():
+                pipeline = profiler.wrap("tokens", ea.tokens, ea.TOKENS_STAGES)
+            tokens = idempotency.exchange(context, pipeline, client)
+        except ExternalAuthError as e:
+            limiter.remember(payload, e)
+            raise
 
         request._cached_user = tokens.user
         request.refresh_token = tokens.refresh_token
 
         return tokens
+
+
+def warm_up() -> None:
+    """Import everything a login needs ahead of the first one,
+    i.e. from a worker's startup"""
+
+    from . import external_auth, idempotency, profiling, ratelimit  # noqa: F401
@@ -0,0 +1,173 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Allocation sites kept in each login's summary
+TOP_ALLOCATIONS = 25
+# Frames kept by tracemalloc for each allocation
+TRACEMALLOC_FRAMES = 10
+# Files written for each profiled login
+EXTENSIONS = (".prof", ".tracemalloc", ".json")
+
+
+class Profiler:
+    """Profiles (cProfile and tracemalloc) a 'rate' fraction of logins,
+    one at a time, into 'directory' keeping the last 'max_logins'.
+    cProfile only sees the login's thread but tracemalloc traces every
+    thread: allocations of the process's other requests at the same time
+    are part of the login's snapshot"""
+
+    def __init__(self, rate: float, directory: str, max_logins: int) -> None:
+        self.rate = rate
+        self.directory = directory
+        self.max_logins = max_logins
+        self._lock = threading.Lock()
+
+    def sample(self) -> bool:
+        return random.random() < self.rate and not self._lock.locked()
+
+    def wrap(
+        self, name: str, fn: Callable[[Any], Any], stages: Iterable[Callable]
+    ) -> Callable[[Any], Any]:
+        """'fn' profiled when no other login is being profiled"""
+
+        def run(context):
+            if not self._lock.acquire(blocking=False):
+                return fn(context)
+            try:
+                return self.profile(name, fn, context, stages)
+            finally:
+                self._lock.release()
+
+        return run
+
+    def profile(self, name: str, fn, context, stages: Iterable[Callable]):
+        profile = cProfile.Profile()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        start = time.perf_counter()
+        error = None
+        profile.enable()
+        try:
+            return fn(context)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            if not tracing:
+                tracemalloc.stop()
+            provider = getattr(getattr(context, "provider", None), "name", "unknown")
+            self.save(name, provider, seconds, error, profile, snapshot, stages)
+
+    def save(self, name, provider, seconds, error, profile, snapshot, stages) -> str:
+        """Write the login's profile, allocations snapshot and summary,
+        returns the path prefix of the files"""
+
+        os.makedirs(self.directory, exist_ok=True)
+        login = f"{time.time_ns()}-{name}-{provider}-{os.getpid()}"
+        prefix = os.path.join(self.directory, re.sub(r"[^\w.-]", "_", login))
+        profile.dump_stats(prefix + ".prof")
+        snapshot.dump(prefix + ".tracemalloc")
+        summary = {
+            "pipeline": name,
+            "provider": provider,
+            "seconds": seconds,
+            "error": type(error).__name__ if error else None,
+            "stages": stage_times(pstats.Stats(profile), stages),
+            "allocations": [
+                {
+                    "where": str(stat.traceback[0]),
+                    "size": stat.size,
+                    "count": stat.count,
+                }
+                for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+            ],
+        }
+        with open(prefix + ".json", "w") as file:
+            json.dump(summary, file, indent=2)
+
+        self.rotate()
+        return prefix
+
+    def rotate(self) -> None:
+        """Delete the files of all but the last 'max_logins' profiled logins"""
+
+        # provider names may have dots and dashes too
+        logins = sorted(
+            {
+                name[: -len(extension)]
+                for name in os.listdir(self.directory)
+                for extension in EXTENSIONS
+                if name.endswith(extension) and name.split("-")[0].isdigit()
+            },
+            key=lambda login: int(login.split("-")[0]),
+        )
+        for login in logins[: max(len(logins) - self.max_logins, 0)]:
+            for extension in EXTENSIONS:
+                try:
+                    os.remove(os.path.join(self.directory, login + extension))
+                except FileNotFoundError:
+                    pass
+
+
+def stage_times(stats: pstats.Stats, stages: Iterable[Callable]) -> Dict[str, dict]:
+    """Cumulative time and calls of each stage function in 'stats'"""
+
+    codes = {
+        (code.co_filename, code.co_firstlineno, code.co_name)
+        for code in (getattr(stage, "__code__", None) for stage in stages)
+        if code
+    }
+    return {
+        key[2]: {"calls": calls, "seconds": cumulative}
+        for key, (_, calls, _, cumulative, _) in stats.stats.items()
+        if key in codes
+    }
+
+
+def profile_rate() -> float:
+    """The EXTERNAL_AUTH_PROFILE_RATE environment variable or else the
+    PROFILE_RATE setting, 0 (disabled) if it isn't a fraction"""
+
+    value = os.environ.get("EXTERNAL_AUTH_PROFILE_RATE") or get_setting("PROFILE_RATE")
+    try:
+        rate = float(value or 0)
+    except (TypeError, ValueError):
+        rate = -1.0
+    if not 0 <= rate <= 1:
+        logger.warning(
+            "Invalid EXTERNAL_AUTH_PROFILE_RATE %r, profiling disabled", value
+        )
+        return 0.0
+    return rate
+
+
+@lru_cache(maxsize=None)
+def get_profiler() -> Optional[Profiler]:
+    """The profiler if enabled by the PROFILE_RATE setting or the
+    EXTERNAL_AUTH_PROFILE_RATE environment variable, read once"""
+
+    rate = profile_rate()
+    if not rate:
+        return None
+    directory = os.environ.get("EXTERNAL_AUTH_PROFILE_DIR") or get_setting(
+        "PROFILE_DIR"
+    )
+    return Profiler(rate, directory, get_setting("PROFILE_MAX_LOGINS"))
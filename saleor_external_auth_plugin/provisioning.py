@@ -0,0 +1,192 @@
+"""Bulk creation of the users of a provider's export and their identities,
+so their first login only updates last_login and their avatars are
+already fetched.
+
+Needs a configured Saleor, i.e.:
+
+DJANGO_SETTINGS_MODULE=saleor.settings python -m \
+    saleor_external_auth_plugin.provisioning google users.jsonl
+
+or python manage.py provision_external_users google users.jsonl
+
+Each record (a JSON object per line, or a CSV row with a header) is a user
+info as returned by the provider: email, first_name/given_name,
+last_name/family_name, sub/id and the avatar url in any field
+"""
+
+import argparse
+import csv
+import json
+import sys
+from dataclasses import dataclass
+from itertools import islice
+from typing import IO, Dict, Iterable, Iterator, List, Optional
+
+import django
+
+BATCH_SIZE = 500
+
+
+@dataclass
+class ProvisionStats:
+    read: int = 0
+    created: int = 0
+    updated: int = 0
+    linked: int = 0
+    skipped: int = 0
+    avatars_queued: int = 0
+
+
+def read_records(file: IO[str], format: str) -> Iterator[dict]:
+    """Stream the records of a "jsonl" or "csv" file"""
+
+    if format == "csv":
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def batches(records: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def provision_batch(
+    provider: str,
+    records: List[dict],
+    stats: ProvisionStats,
+    avatars_per_second: Optional[float],
+) -> ProvisionStats:
+    """Upsert the users of 'records' with one query for the existing ones, one
+    bulk insert and one bulk update, then link them to their subject at
+    'provider' with another bulk insert. Users without avatar get its download
+    queued, spread at 'avatars_per_second' (all at once when None)"""
+
+    from django.db import transaction
+    from saleor.account.models import User
+
+    from . import external_auth as ea
+    from .models import ExternalIdentity
+    from .tasks import sync_user_avatar_task
+
+    users: Dict[str, tuple] = {}
+    for record in records:
+        stats.read += 1
+        email, names, avatar_uri = ea.user_info_fields(record)
+        if not email:
+            stats.skipped += 1
+            continue
+        # the last record of an email wins
+        users[email] = (names, avatar_uri, ea.user_subject(record))
+
+    existing = {user.email: user for user in User.objects.filter(email__in=users)}
+    created, updated, changed_fields = [], [], set()
+    for email, (names, _, _) in users.items():
+        user = existing.get(email)
+        if not user:
+            created.append(User(email=email, **{k: v or "" for k, v in names.items()}))
+            continue
+        changed = ea.update_fields(user, names)
+        if changed:
+            updated.append(user)
+            changed_fields.update(changed)
+
+    new = User.objects.filter(email__in=[user.email for user in created])
+    with transaction.atomic():
+        # users that logged in meanwhile are left as they are, so the
+        # inserted ones are counted (ignore_conflicts doesn't tell)
+        before = new.count()
+        User.objects.bulk_create(created, ignore_conflicts=True)
+        stats.created += new.count() - before
+        if updated:
+            User.objects.bulk_update(updated, sorted(changed_fields))
+    stats.updated += len(updated)
+
+    provisioned = User.objects.filter(email__in=users).values_list(
+        "email", "pk", "avatar"
+    )
+    identities = [
+        ExternalIdentity(provider=provider, subject=users[email][2], user_id=pk)
+        for email, pk, _ in provisioned
+        if users[email][2]
+    ]
+    # subjects already linked, by a login or a previous run, are left as they are
+    ExternalIdentity.objects.bulk_create(identities, ignore_conflicts=True)
+    stats.linked += len(identities)
+
+    for email, pk, avatar in provisioned:
+        avatar_uri = users[email][1]
+        if avatar or not avatar_uri:
+            continue
+        countdown = (
+            stats.avatars_queued / avatars_per_second if avatars_per_second else 0
+        )
+        sync_user_avatar_task.apply_async(
+            kwargs={"user_id": pk, "avatar_uri": avatar_uri}, countdown=countdown
+        )
+        stats.avatars_queued += 1
+
+    return stats
+
+
+def provision(
+    provider: str,
+    records: Iterable[dict],
+    batch_size: int = BATCH_SIZE,
+    avatars_per_second: Optional[float] = None,
+) -> Iterator[ProvisionStats]:
+    """Upsert the users of 'records' exported from 'provider' (its configured
+    name) in batches, yielding the running totals after each batch"""
+
+    from .external_auth import identity_provider
+
+    stats = ProvisionStats()
+    for batch in batches(records, batch_size):
+        yield provision_batch(
+            identity_provider(provider), batch, stats, avatars_per_second
+        )
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("provider", help="the provider's configured name")
+    parser.add_argument("file", help="export file, - for stdin")
+    parser.add_argument("--format", choices=["jsonl", "csv"])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--avatars-per-second", type=float)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def run(args: argparse.Namespace) -> ProvisionStats:
+    format = args.format or ("csv" if args.file.endswith(".csv") else "jsonl")
+    file = sys.stdin if args.file == "-" else open(args.file, newline="")
+    with file:
+        stats = ProvisionStats()
+        for stats in provision(
+            args.provider,
+            read_records(file, format),
+            args.batch_size,
+            args.avatars_per_second,
+        ):
+            print(json.dumps(stats.__dict__), file=sys.stderr)
+    return stats
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    django.setup()
+    print(json.dumps(run(args).__dict__))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from django.core.cache import caches
+
+from . import constants
+from .conf import get_setting
+from .external_auth_types import ExternalAuthError, RateLimitedError
+from .state import MemoryStateStore
+
+# Authorization codes longer than this are rejected unseen
+MAX_CODE_LENGTH = 2048
+# Causes of the errors worth remembering, the same payload fails again
+REJECTED_CAUSES = frozenset(["invalid_payload", "unknown_provider", "invalid_state"])
+
+# (tokens, last refill time)
+Bucket = Tuple[float, float]
+
+
+def refill(bucket: Optional[Bucket], rate: float, burst: int, now: float) -> Bucket:
+    tokens, updated = bucket or (burst, now)
+    return min(burst, tokens + (now - updated) * rate), now
+
+
+class Buckets:
+    """Token buckets by key, refilled at 'rate' tokens per second up to 'burst'"""
+
+    def take(self, key: str, rate: float, burst: int) -> bool:
+        """Take a token from the bucket of 'key', False if it's empty"""
+        raise NotImplementedError
+
+
+class MemoryBuckets(Buckets):
+    """Per process buckets, the least recently used are dropped when full"""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._buckets: "OrderedDict[str, Bucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: int) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, _ = refill(self._buckets.pop(key, None), rate, burst, now)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - allowed, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return allowed
+
+
+class CacheBuckets(Buckets):
+    """Buckets in a Django cache shared by all processes. Reads and writes
+    aren't atomic, concurrent requests may take the same token"""
+
+    prefix = "external_auth:bucket:"
+
+    def __init__(self, alias: str) -> None:
+        self.cache = caches[alias]
+
+    def take(self, key: str, rate: float, burst: int) -> bool:
+        now = time.time()
+        tokens, _ = refill(self.cache.get(self.prefix + key), rate, burst, now)
+        allowed = tokens >= 1
+        # a bucket left alone until it's full again is the same as no bucket
+        timeout = int(burst / rate) + 1 if rate else None
+        self.cache.set(self.prefix + key, (tokens - allowed, now), timeout)
+        return allowed
+
+
+def client_ip(request) -> Optional[str]:
+    """The client's IP for its bucket, see RATE_LIMIT_TRUSTED_PROXIES"""
+
+    proxies = get_setting("RATE_LIMIT_TRUSTED_PROXIES")
+    if proxies is None:
+        from saleor.core.utils import get_client_ip
+
+        return get_client_ip(request)
+
+    addresses = [request.META.get("REMOTE_ADDR")]
+    forwarded = request.META.get("HTTP_X_FORWARDED_FOR")
+    if forwarded:
+        addresses = [a.strip() for a in forwarded.split(",")] + addresses
+    # each trusted proxy appended the address it received the request from
+    return addresses[max(len(addresses) - 1 - proxies, 0)]
+
+
+def payload_key(payload: dict) -> str:
+    values = (payload.get("provider"), payload.get("code"), payload.get("state"))
+    return hashlib.sha256(repr(values).encode()).hexdigest()
+
+
+class RateLimiter:
+    """Rejects token requests before the provider is called: remembered bad
+    payloads, malformed ones and those exceeding the client's (by IP) or,
+    once their state is checked, the provider's bucket"""
+
+    def __init__(self, buckets: Optional[Buckets], rejected_size: int) -> None:
+        self.buckets = buckets
+        self.rejected = MemoryStateStore(rejected_size)
+
+    def check_payload(self, payload: dict) -> None:
+        rejected = self.rejected.get(payload_key(payload))
+        if rejected:
+            raise ExternalAuthError(rejected["message"], rejected["cause"])
+
+        code, state = payload.get("code"), payload.get("state")
+        if not (
+            isinstance(payload.get("provider"), str)
+            and isinstance(code, str)
+            and 0 < len(code) <= MAX_CODE_LENGTH
+            and isinstance(state, str)
+            and 0 < len(state) <= constants.MAX_STATE_LENGTH
+        ):
+            raise ExternalAuthError("Invalid request payload", "invalid_payload")
+
+    def check_client(self, ip: Optional[str]) -> None:
+        if self.buckets and not self.buckets.take(
+            f"ip:{ip}",
+            get_setting("RATE_LIMIT_IP_RATE"),
+            get_setting("RATE_LIMIT_IP_BURST"),
+        ):
+            raise RateLimitedError("client")
+
+    def check_provider(self, name: str) -> None:
+        if self.buckets and not self.buckets.take(
+            f"provider:{name}",
+            get_setting("RATE_LIMIT_PROVIDER_RATE"),
+            get_setting("RATE_LIMIT_PROVIDER_BURST"),
+        ):
+            raise RateLimitedError(name)
+
+    def remember(self, payload: dict, error: ExternalAuthError) -> None:
+        """Keep the rejection of 'payload' if it would fail the same way again"""
+
+        if error.cause in REJECTED_CAUSES:
+            self.rejected.put(
+                payload_key(payload),
+                {"message": error.value, "cause": error.cause},
+                get_setting("REJECTED_PAYLOAD_TTL"),
+            )
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """The limiter with the buckets of the RATE_LIMIT_STORE setting"""
+
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                store = get_setting("RATE_LIMIT_STORE")
+                buckets: Optional[Buckets] = None
+                if store == "memory":
+                    buckets = MemoryBuckets(get_setting("RATE_LIMIT_MEMORY_SIZE"))
+                elif store == "cache":
+                    buckets = CacheBuckets(get_setting("RATE_LIMIT_CACHE_ALIAS"))
+                _limiter = RateLimiter(buckets, get_setting("RATE_LIMIT_MEMORY_SIZE"))
+    return _limiter
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from django.core.cache import caches
+
+from .conf import get_setting
+
+
+class StateStore:
+    """Keeps what an authentication url was made with until its callback,
+    keyed by the url's state. Each state can be consumed only once"""
+
+    def put(self, state: str, value: dict, ttl: int) -> None:
+        raise NotImplementedError
+
+    def get(self, state: str) -> Optional[dict]:
+        """Value of 'state' without consuming it"""
+        raise NotImplementedError
+
+    def put_many(self, values: Dict[str, dict], ttl: int) -> None:
+        for state, value in values.items():
+            self.put(state, value, ttl)
+
+    def pop(self, state: str) -> Optional[dict]:
+        """Atomically get and remove the value of 'state', None
+        if it doesn't exist, expired or was already consumed"""
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """Per process store, the least recently stored states are dropped
+    when it's full. Only for single process deployments"""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._states: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, state: str, value: dict, ttl: int) -> None:
+        with self._lock:
+            self._states[state] = (time.monotonic() + ttl, value)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def get(self, state: str) -> Optional[dict]:
+        expires, value = self._states.get(state, (0, None))
+        return value if expires > time.monotonic() else None
+
+    def pop(self, state: str) -> Optional[dict]:
+        with self._lock:
+            expires, value = self._states.pop(state, (0, None))
+        return value if expires > time.monotonic() else None
+
+
+class CacheStateStore(StateStore):
+    """Store in a Django cache, shared by all processes using it"""
+
+    prefix = "external_auth:state:"
+
+    def __init__(self, alias: str) -> None:
+        self.cache = caches[alias]
+
+    def put(self, state: str, value: dict, ttl: int) -> None:
+        self.cache.set(self.prefix + state, value, ttl)
+
+    def put_many(self, values: Dict[str, dict], ttl: int) -> None:
+        self.cache.set_many({self.prefix + k: v for k, v in values.items()}, ttl)
+
+    def get(self, state: str) -> Optional[dict]:
+        return self.cache.get(self.prefix + state)
+
+    def pop(self, state: str) -> Optional[dict]:
+        value = self.cache.get(self.prefix + state)
+        # only the caller that actually deleted the key consumes the state
+        if value is None or not self.cache.delete(self.prefix + state):
+            return None
+        return value
+
+
+_store: Optional[StateStore] = None
+_store_lock = threading.Lock()
+
+
+def get_state_store() -> StateStore:
+    """The store configured by the STATE_STORE setting ("cache" or "memory")"""
+
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None and get_setting("STATE_STORE") == "memory":
+                _store = MemoryStateStore(get_setting("STATE_MEMORY_SIZE"))
+            elif _store is None:
+                _store = CacheStateStore(get_setting("STATE_CACHE_ALIAS"))
+    return _store
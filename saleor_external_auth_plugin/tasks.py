@@ -0,0 +1,45 @@
+from typing import List, Optional
+
+from saleor.account.models import User
+from saleor.celeryconf import app
+
+from . import avatars, constants
+from .external_auth_types import ExternalAuthError, InvalidAvatarError
+
+
+@app.task(
+    autoretry_for=(ExternalAuthError,),
+    retry_backoff=True,
+    max_retries=constants.AVATAR_SYNC_MAX_RETRIES,
+)
+def sync_user_avatar_task(
+    user_id: int, avatar_uri: str, refresh_interval: Optional[int] = None
+) -> None:
+    """Fetch, validate and store the provider's avatar of a user without one,
+    or refresh it if 'refresh_interval' (seconds) passed since the last check"""
+
+    user = User.objects.filter(pk=user_id).first()
+    if not user:
+        return
+    user.avatar_uri = avatar_uri
+    if not avatars.needs_refresh(user, refresh_interval):
+        return
+
+    try:
+        changed = avatars.update_avatar(user)
+    except InvalidAvatarError:
+        # the same url will be rejected again, no retries. The rejection
+        # is kept so logins don't queue it again
+        avatars.save_avatar(user, [])
+        return
+    if changed:
+        avatars.save_avatar(user, ["avatar"])
+        # Saleor makes the missing ones on demand
+        avatars.share_thumbnails(user)
+    else:
+        avatars.save_avatar(user, [])
+
+
+@app.task
+def delete_unused_avatar_task(name: Optional[str], thumbnails: List[str]) -> None:
+    avatars.delete_unused_avatar(name, thumbnails)
@@ -1,33 +1,49 @@
+import io
+
 import pytest
-from ..external_auth_types import Context, Provider, User
+import requests
+from saleor.account.models import User
+
+from ..constants import DEFAULT_CONFIGURATION_TEXT
+from ..external_auth_types import Context, Provider, Uri
 
 providers_dict = {
     "google": Provider(
-        provider_name="google",
+        name="google",
         client_id="your google id",
         client_secret="your google secret",
         redirect_uri="http://localhost:3000/auth/google",
-        auth_uri="https://accounts.google.com/o/oauth2/v2/auth",
-        auth_scope="openid email profile",
-        auth_accesss_type="offline",
-        auth_include_granted_scopes="true",
-        auth_response_type="code",
-        tokens_uri="https://oauth2.googleapis.com/token",
-        tokens_grant_type="authorization_code",
-        user_info_uri="https://www.googleapis.com/oauth2/v2/userinfo",
+        auth_uri=Uri(
+            path="https://accounts.google.com/o/oauth2/v2/auth",
+            extra_params={
+                "scope": "openid email profile",
+                "access_type": "offline",
+                "include_granted_scopes": "true",
+                "response_type": "code",
+            },
+        ),
+        tokens_uri=Uri(
+            path="https://oauth2.googleapis.com/token",
+            extra_params={"grant_type": "authorization_code"},
+        ),
+        user_info_uri=Uri(path="https://www.googleapis.com/oauth2/v2/userinfo"),
     ),
     "facebook": Provider(
-        provider_name="facebook",
+        name="facebook",
         client_id="your facebook id",
         client_secret="your facebook secret",
-        redirect_uri="http://localhost:300...uth/facebook",
-        auth_uri="https://www.facebook.com/v13.0/dialog/oauth",
-        auth_accesss_type="offline",
-        auth_include_granted_scopes="true",
-        auth_response_type="code",
-        tokens_uri="https://graph.facebook.com/v13.0/oauth/access_token",
-        tokens_grant_type="authorization_code",
-        user_info_uri="https://graph.facebook.com/v13.0/me?fields=id,name,email,first_name,last_name,middle_name,is_guest_user,picture{url,height,width}",
+        redirect_uri="http://localhost:3000/auth/facebook",
+        auth_uri=Uri(path="https://www.facebook.com/v13.0/dialog/oauth"),
+        tokens_uri=Uri(
+            path="https://graph.facebook.com/v13.0/oauth/access_token",
+            extra_params={"grant_type": "authorization_code"},
+        ),
+        user_info_uri=Uri(
+            path="https://graph.facebook.com/v13.0/me",
+            extra_params={
+                "fields": "id,name,email,first_name,last_name,middle_name,is_guest_user,picture{url,height,width}"
+            },
+        ),
     ),
 }
 
@@ -39,8 +55,8 @@ def config():
             "name": "providers_config_list",
             "type": "Multiline",
             "label": "Providers Configuration List",
-            "help_text": "Provide all necessar...h provider",
-            "value": '{\n    "GOOGLE": \n        {\n            "PROVIDER_NAME":"google",\n            "CLIENT_ID": "your google id",\n            "CLIENT_SECRET": "your google secret",\n            "REDIRECT_URI": "http://localhost:3000/auth/google",\n            "AUTH_URI": "https://accounts.google.com/o/oauth2/v2/auth",\n            "AUTH_SCOPE": "openid email profile",\n            "AUTH_ACCESSS_TYPE": "offline",\n            "AUTH_INCLUDE_GRANTED_SCOPES": "true",\n            "AUTH_RESPONSE_TYPE": "code",\n            "TOKENS_URI": "https://oauth2.googleapis.com/token",\n            "TOKENS_GRANT_TYPE": "authorization_code",\n            "USER_INFO_URI": "https://www.googleapis.com/oauth2/v2/userinfo"\n        },\n    "FACEBOOK":\n        {\n            "PROVIDER_NAME":"facebook",\n            "CLIENT_ID": "your facebook id",\n            "CLIENT_SECRET": "your facebook secret",\n            "REDIRECT_URI": "http://localhost:3000/auth/facebook",\n            "AUTH_URI": "https://www.facebook.com/v13.0/dialog/oauth",\n            "AUTH_ACCESSS_TYPE": "offline",\n            "AUTH_INCLUDE_GRANTED_SCOPES": "true",\n            "AUTH_RESPONSE_TYPE": "code",\n            "TOKENS_URI": "https://graph.facebook.com/v13.0/oauth/access_token",\n            "TOKENS_GRANT_TYPE": "authorization_code",\n            "USER_INFO_URI": "https://graph.facebook.com/v13.0/me?fields=id,name,email,first_name,last_name,middle_name,is_guest_user,picture{url,height,width}"\n        }\n}',
+            "help_text": "Provide all necessary configuration for each provider",
+            "value": DEFAULT_CONFIGURATION_TEXT,
         }
     ]
 
@@ -94,6 +110,11 @@ def userinfo():
     }
 
 
+@pytest.fixture
+def context_with_user_info(context_with_credentials, userinfo):
+    return context_with_credentials.with_data(user_info=userinfo)
+
+
 @pytest.fixture
 def user():
     user = User(
@@ -105,3 +126,18 @@ def user():
     user.avatar_uri = "http://somesite.com/pic.jpg"
 
     return user
+
+
+@pytest.fixture
+def context_with_user(context_with_user_info, user):
+    return context_with_user_info.with_data(user=user)
+
+
+def image_response(content: bytes, content_type: str = "image/png", status=200):
+    """Streamable requests response with 'content' as body"""
+
+    response = requests.Response()
+    response.status_code = status
+    response.headers["Content-Type"] = content_type
+    response.raw = io.BytesIO(content)
+    return response
@@ -1,13 +1,23 @@
-from django.http import HttpResponse
+import hashlib
+from urllib.parse import parse_qs, urlparse
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 import pytest
 from .. import external_auth as ea
+from .. import tasks
 from ..external_auth_types import Context, ExternalAuthError
+from ..models import ExternalIdentity
+from ..benchmarks.stub_provider import make_png
 from .fixtures import (
+    image_response,
     config,
     providers,
     credentials,
     context,
     context_with_credentials,
+    context_with_user_info,
+    context_with_user,
     userinfo,
     user,
     providers_dict,
@@ -29,6 +39,27 @@ def test_get_providers_from_config(config):
     assert ea.get_providers_from_config(config)
 
 
+def test_get_providers_from_config_is_cached(monkeypatch, config):
+    ea.clear_providers_cache()
+    providers = ea.get_providers_from_config(config)
+
+    def mocked_parse(providers_config):
+        raise AssertionError("configuration parsed again")
+
+    monkeypatch.setattr(ea, "parse_providers_config", mocked_parse)
+
+    assert ea.get_providers_from_config(config) is providers
+    with pytest.raises(TypeError):
+        providers["github"] = providers["google"]
+
+
+def test_get_providers_from_config_after_clear_cache(config):
+    providers = ea.get_providers_from_config(config)
+    ea.clear_providers_cache()
+
+    assert ea.get_providers_from_config(config) is not providers
+
+
 @pytest.mark.parametrize("input", ["", {"redirect": "http"}, {"provider": "github"}])
 def test_get_context_with_empty_provider(providers, input):
     with pytest.raises(ExternalAuthError):
@@ -39,13 +70,104 @@ def test_get_context(providers):
     assert ea.get_context(providers)({"provider": "google"})
 
 
+def test_get_context_normalizes_provider_name(providers):
+    assert ea.get_context(providers)({"provider": " Google "}).provider.name == (
+        "google"
+    )
+
+
+def test_provider_is_compiled():
+    google = providers_dict["google"]
+
+    assert google.auth_url.startswith(
+        "https://accounts.google.com/o/oauth2/v2/auth?client_id=your+google+id&"
+    )
+    assert google.authorization_url({"state": "a&b"}).endswith("&state=a%26b")
+    assert google.tokens_data["grant_type"] == "authorization_code"
+    assert (
+        providers_dict["facebook"]
+        .user_info_url("token")
+        .startswith(
+            "https://graph.facebook.com/v13.0/me?access_token=token&fields=id%2Cname"
+        )
+    )
+
+
+def test_check_state(context):
+    params = ea.get_state(context)
+    context.payload["state"] = params["state"]
+
+    checked = ea.check_state(context)
+
+    assert checked.data["state"]["provider"] == "google"
+    assert ea.pkce_challenge(checked.data["state"]["code_verifier"]) == (
+        params["code_challenge"]
+    )
+    assert ea.credentials_request(checked)["code_verifier"]
+
+
+@pytest.mark.parametrize(
+    "requested, names",
+    [
+        (None, None),
+        ("all", ["google", "facebook"]),
+        ([" Google", "google"], ["google"]),
+    ],
+)
+def test_requested_providers(providers, requested, names):
+    payload = {} if requested is None else {"providers": requested}
+
+    assert ea.requested_providers(providers, payload) == names
+
+
+@pytest.mark.parametrize("requested", ["google", [1], ["github"]])
+def test_requested_providers_invalid(providers, requested):
+    with pytest.raises(ExternalAuthError):
+        ea.requested_providers(providers, {"providers": requested})
+
+
+def test_authorization_urls(providers):
+    urls = ea.authorization_urls(providers, ["google", "facebook"], {})
+
+    for name, url in urls.items():
+        state = parse_qs(urlparse(url).query)["state"][0]
+        context = Context(payload={"state": state}, provider=providers[name])
+        assert ea.check_state(context).data["state"]["provider"] == name
+
+
+@pytest.mark.parametrize("state", [None, "", "unknown", "x" * 1000])
+def test_check_state_with_invalid_state(context, state):
+    context.payload["state"] = state
+
+    with pytest.raises(ExternalAuthError):
+        ea.check_state(context)
+
+
+def test_check_state_is_single_use(context):
+    context.payload["state"] = ea.get_state(context)["state"]
+    ea.check_state(context)
+
+    with pytest.raises(ExternalAuthError):
+        ea.check_state(context)
+
+
+def test_check_state_of_other_provider(context):
+    context.payload["state"] = ea.get_state(context)["state"]
+    facebook = Context(payload=context.payload, provider=providers_dict["facebook"])
+
+    with pytest.raises(ExternalAuthError):
+        ea.check_state(facebook)
+
+
 def test_get_credentials(monkeypatch, context):
     json = {"token_type": "JWT", "access_token": "ioaUSHDAHwe9238hidnfiqh2wr89o"}
 
-    def mocked_post(uri, *args, **kwargs):
-        return type("MockedReq", (), {"json": lambda *x, **y: json})()
+    def mocked_request(session, method, uri, *args, **kwargs):
+        return type(
+            "MockedReq", (), {"status_code": 200, "json": lambda *x, **y: json}
+        )()
 
-    monkeypatch.setattr(ea.get_credentials.__globals__["requests"], "post", mocked_post)
+    monkeypatch.setattr(ea.requests.Session, "request", mocked_request)
     assert ea.get_credentials(context) == Context(
         data={"credentials": json},
         payload={
@@ -59,16 +181,16 @@ def test_get_credentials(monkeypatch, context):
 def test_get_credentials_when_invalid_request(monkeypatch, context):
     with pytest.raises(ExternalAuthError):
 
-        def mocked_post(uri, *args, **kwargs):
+        def mocked_request(session, method, uri, *args, **kwargs):
             json = {
                 "error": "unsupported_grant_type",
                 "error_description": "Invalid grant_type: ",
             }
-            return type("MockedReq", (), {"json": lambda *x, **y: json})()
+            return type(
+                "MockedReq", (), {"status_code": 400, "json": lambda *x, **y: json}
+            )()
 
-        monkeypatch.setattr(
-            ea.get_credentials.__globals__["requests"], "post", mocked_post
-        )
+        monkeypatch.setattr(ea.requests.Session, "request", mocked_request)
         ea.get_credentials(context)
 
 
@@ -80,11 +202,13 @@ def test_get_userinfo(monkeypatch, context_with_credentials):
         "picture": "http://somesite.com/pic.jpg",
     }
 
-    def mocked_get(uri, *args, **kwargs):
-        return type("MockedReq", (), {"json": lambda *x, **y: json})()
+    def mocked_request(session, method, uri, *args, **kwargs):
+        return type(
+            "MockedReq", (), {"status_code": 200, "json": lambda *x, **y: json}
+        )()
 
-    monkeypatch.setattr(ea.get_userinfo.__globals__["requests"], "get", mocked_get)
-    assert ea.get_userinfo(context_with_credentials) == json
+    monkeypatch.setattr(ea.requests.Session, "request", mocked_request)
+    assert ea.get_user_info(context_with_credentials).data["user_info"] == json
 
 
 def test_get_userinfo_with_invalid_request(monkeypatch, context_with_credentials):
@@ -94,15 +218,17 @@ def test_get_userinfo_with_invalid_request(monkeypatch, context_with_credentials
             "error_description": "Invalid grant_type: ",
         }
 
-        def mocked_get(uri, *args, **kwargs):
-            return type("MockedReq", (), {"json": lambda *x, **y: json})()
+        def mocked_request(session, method, uri, *args, **kwargs):
+            return type(
+                "MockedReq", (), {"status_code": 400, "json": lambda *x, **y: json}
+            )()
 
-        monkeypatch.setattr(ea.get_userinfo.__globals__["requests"], "get", mocked_get)
-        ea.get_userinfo(context_with_credentials)
+        monkeypatch.setattr(ea.requests.Session, "request", mocked_request)
+        ea.get_user_info(context_with_credentials)
 
 
-def test_get_user(userinfo):
-    user = ea.get_user(userinfo)
+def test_get_user(context_with_user_info):
+    user = ea.get_user(context_with_user_info).data["user"]
 
     assert (
         user.email == "john@doe.com"
@@ -110,23 +236,191 @@ def test_get_user(userinfo):
     )
 
 
+def login_queries(queries) -> list:
+    """First word of each SQL statement, savepoints left out"""
+    statements = [q["sql"].split()[0].upper() for q in queries]
+    return [s for s in statements if s not in ("SAVEPOINT", "RELEASE")]
+
+
 @pytest.mark.django_db
-def test_update_user(monkeypatch, user):
-    json = HttpResponse(b"image", headers={"Content-Type": "image/jpeg"})
-    filename = user.email.replace("@", "").replace(".", "")
+def test_login_of_new_user_queries(monkeypatch, context_with_user_info):
+    monkeypatch.setattr(ea.sync_user_avatar_task, "delay", lambda **kwargs: None)
 
-    def mocked_get(uri, *args, **kwargs):
-        return type("MockedReq", (), {"json": lambda *x, **y: json})()
+    with CaptureQueriesContext(connection) as queries:
+        ea.update_user(ea.get_user(context_with_user_info))
 
-    monkeypatch.setattr(ea.update_user.__globals__["requests"], "get", mocked_get)
-    user = ea.update_user(user)
+    assert login_queries(queries) == ["SELECT", "INSERT"]
 
-    assert (
-        user.email == "john@doe.com"
-        and user.is_active == True
-        and filename in user.avatar.name
+
+@pytest.mark.django_db
+def test_login_of_returning_user_queries(
+    monkeypatch, context_with_user_info, django_assert_num_queries
+):
+    monkeypatch.setattr(ea.sync_user_avatar_task, "delay", lambda **kwargs: None)
+    ea.update_user(ea.get_user(context_with_user_info))
+    renamed = context_with_user_info.with_data(
+        user_info={**context_with_user_info.data["user_info"], "given_name": "Johnny"}
+    )
+
+    with django_assert_num_queries(2):
+        user = ea.update_user(ea.get_user(renamed)).data["user"]
+
+    user.refresh_from_db()
+    assert user.first_name == "Johnny" and user.last_name == "Doe"
+
+
+@pytest.mark.django_db
+def test_login_of_returning_user_buffers_last_login(
+    monkeypatch, context_with_user_info, django_assert_num_queries
+):
+    monkeypatch.setattr(ea.sync_user_avatar_task, "delay", lambda **kwargs: None)
+    ea.update_user(ea.get_user(context_with_user_info))
+    buffer = ea.last_login.MemoryLastLoginBuffer(flush_size=10, max_staleness=3600)
+    monkeypatch.setattr(ea.last_login, "get_buffer", lambda: buffer)
+
+    with django_assert_num_queries(1):
+        user = ea.update_user(ea.get_user(context_with_user_info)).data["user"]
+
+    assert buffer.pending() == 1
+    buffer.flush()
+    user.refresh_from_db()
+    assert user.last_login
+
+
+@pytest.mark.django_db
+def test_login_with_subject_links_identity(monkeypatch, context_with_user_info):
+    monkeypatch.setattr(ea.sync_user_avatar_task, "delay", lambda **kwargs: None)
+    with_subject = context_with_user_info.with_data(
+        user_info={**context_with_user_info.data["user_info"], "id": "1234"}
     )
 
+    with CaptureQueriesContext(connection) as queries:
+        user = ea.update_user(ea.get_user(with_subject)).data["user"]
+
+    assert login_queries(queries) == ["SELECT", "SELECT", "INSERT", "INSERT"]
+    identity = ExternalIdentity.objects.get(provider="google", subject="1234")
+    assert identity.user == user
+
+    # the email changed at the provider, the user is found by subject
+    changed_email = with_subject.with_data(
+        user_info={**with_subject.data["user_info"], "email": "john@new.com"}
+    )
+    with CaptureQueriesContext(connection) as queries:
+        returning = ea.update_user(ea.get_user(changed_email)).data["user"]
+
+    assert returning.pk == user.pk
+    assert login_queries(queries) == ["SELECT", "UPDATE"]
+
+
+@pytest.mark.django_db
+def test_login_links_existing_user_by_email(monkeypatch, context_with_user_info):
+    monkeypatch.setattr(ea.sync_user_avatar_task, "delay", lambda **kwargs: None)
+    user = ea.update_user(ea.get_user(context_with_user_info)).data["user"]
+    with_subject = context_with_user_info.with_data(
+        user_info={**context_with_user_info.data["user_info"], "sub": "abc"}
+    )
+
+    assert ea.update_user(ea.get_user(with_subject)).data["user"].pk == user.pk
+    assert user.external_identities.get().subject == "abc"
+
+
+@pytest.mark.django_db
+def test_get_user_without_email_nor_identity(context_with_user_info):
+    without_email = context_with_user_info.with_data(user_info={"id": "1234"})
+
+    with pytest.raises(ExternalAuthError):
+        ea.get_user(without_email)
+
+
+@pytest.mark.django_db
+def test_update_user(
+    monkeypatch, context_with_user, django_capture_on_commit_callbacks
+):
+    scheduled = []
+    monkeypatch.setattr(
+        ea.sync_user_avatar_task, "delay", lambda **kwargs: scheduled.append(kwargs)
+    )
+
+    with django_capture_on_commit_callbacks(execute=True):
+        user = ea.sync_avatar(ea.update_user(context_with_user)).data["user"]
+
+    assert user.pk and user.last_login and not user.avatar
+    assert scheduled == [
+        {
+            "user_id": user.pk,
+            "avatar_uri": "http://somesite.com/pic.jpg",
+            "refresh_interval": None,
+        }
+    ]
+
+
+@pytest.mark.django_db
+def test_sync_user_avatar_task(monkeypatch, user):
+    image = make_png(8)
+
+    def mocked_request(session, method, uri, *args, **kwargs):
+        return image_response(image)
+
+    monkeypatch.setattr(ea.requests.Session, "request", mocked_request)
+    user.save()
+    tasks.sync_user_avatar_task(user.pk, user.avatar_uri)
+    user.refresh_from_db()
+
+    assert user.is_active == True
+    assert hashlib.sha256(image).hexdigest() in user.avatar.name
+    assert tasks.avatars.get_avatar_source(user)["url"] == user.avatar_uri
+
+
+@pytest.mark.django_db
+def test_sync_user_avatar_task_remembers_rejected_avatar(monkeypatch, user):
+    requested = []
+
+    def mocked_request(session, method, uri, *args, **kwargs):
+        requested.append(uri)
+        return image_response(b"<html></html>", content_type="text/html")
+
+    monkeypatch.setattr(ea.requests.Session, "request", mocked_request)
+    user.save()
+    tasks.sync_user_avatar_task(user.pk, user.avatar_uri)
+    user.refresh_from_db()
+    user.avatar_uri = "http://somesite.com/pic.jpg"
+
+    assert tasks.avatars.get_avatar_source(user)["rejected"]
+    assert not tasks.avatars.needs_refresh(user, None)
+    tasks.sync_user_avatar_task(user.pk, user.avatar_uri)
+    assert len(requested) == 1
+
+    user.avatar_uri = "http://somesite.com/new.jpg"
+    assert tasks.avatars.needs_refresh(user, None)
+
+
+@pytest.mark.django_db
+def test_sync_user_avatar_task_when_not_modified(monkeypatch, user):
+    image = make_png(8)
+    status = [200]
+    requests_headers = []
+
+    def mocked_request(session, method, uri, *args, **kwargs):
+        requests_headers.append(kwargs.get("headers"))
+        return image_response(image, status=status[0])
+
+    monkeypatch.setattr(ea.requests.Session, "request", mocked_request)
+    user.save()
+    tasks.sync_user_avatar_task(user.pk, user.avatar_uri)
+    user.refresh_from_db()
+    avatar = user.avatar.name
+
+    # checked recently, nothing is requested
+    tasks.sync_user_avatar_task(user.pk, user.avatar_uri, refresh_interval=3600)
+    assert len(requests_headers) == 1
+
+    status[0] = 304
+    tasks.sync_user_avatar_task(user.pk, user.avatar_uri, refresh_interval=0)
+    user.refresh_from_db()
+
+    assert len(requests_headers) == 2
+    assert user.avatar.name == avatar
+
 
 # def test_get_tokens(context):
 #     ...
@@ -0,0 +1,170 @@
+import hashlib
+import importlib.util
+
+import pytest
+from django.core.exceptions import ValidationError
+from saleor.account.models import User
+
+from .. import avatars, tasks
+from ..benchmarks.stub_provider import make_png
+from ..external_auth_types import InvalidAvatarError
+from .fixtures import image_response
+
+
+@pytest.mark.parametrize(
+    "head, content_type",
+    [
+        (make_png(1), "image/png"),
+        (b"\xff\xd8\xff\xe0\x00\x10JFIF", "image/jpeg"),
+        (b"GIF89a\x01\x00\x01\x00", "image/gif"),
+        (b"RIFF\x24\x00\x00\x00WEBPVP8 ", "image/webp"),
+        (b"<html><body>", None),
+    ],
+)
+def test_sniff_content_type(head, content_type):
+    assert avatars.sniff_content_type(head) == content_type
+
+
+def test_download():
+    image = make_png(8)
+
+    with avatars.download(image_response(image), "uri") as download:
+        assert download.file.read() == image
+        assert download.size == len(image) and download.content_type == "image/png"
+
+
+@pytest.mark.parametrize(
+    "response",
+    [
+        image_response(make_png(8), "text/html"),
+        image_response(b"<html><body>not an image</body></html>"),
+        image_response(b"\x89PNG"),
+    ],
+)
+def test_download_rejects_non_images(response):
+    with pytest.raises(InvalidAvatarError):
+        with avatars.download(response, "uri"):
+            pass
+
+
+def test_download_stops_at_max_size(monkeypatch, settings):
+    settings.EXTERNAL_AUTH_AVATAR_MAX_SIZE = 100
+    monkeypatch.setattr(avatars.constants, "AVATAR_CHUNK_SIZE", 16)
+    image = make_png(64)
+    response = image_response(image)
+
+    with pytest.raises(InvalidAvatarError):
+        with avatars.download(response, "uri"):
+            pass
+    # the rest isn't read
+    assert response.raw.tell() <= 100 + 16 < len(image)
+
+
+def test_download_rejects_declared_size(settings):
+    settings.EXTERNAL_AUTH_AVATAR_MAX_SIZE = 100
+    response = image_response(make_png(8))
+    response.headers["Content-Length"] = "1000000"
+
+    with pytest.raises(InvalidAvatarError):
+        with avatars.download(response, "uri"):
+            pass
+    assert response.raw.tell() == 0
+
+
+def test_download_rejects_invalid_declared_size():
+    response = image_response(make_png(8))
+    response.headers["Content-Length"] = "12, 12"
+
+    with pytest.raises(InvalidAvatarError) as error:
+        with avatars.download(response, "uri"):
+            pass
+    assert error.value.reason == "invalid content length"
+
+
+@pytest.mark.django_db
+def test_sync_user_avatar_task_rejects_image_failing_validation(monkeypatch):
+    # a PNG signature passes sniffing, the rest isn't an image
+    image = make_png(1)[:12] + b"not an image" * 4
+    monkeypatch.setattr(
+        avatars.http_client, "request", lambda *args, **kwargs: image_response(image)
+    )
+
+    def validate_image_file(file, field_name, error_class):
+        raise ValidationError("Invalid file.", code=error_class.INVALID.value)
+
+    monkeypatch.setattr(avatars, "validate_image_file", validate_image_file)
+    user = User.objects.create(email="user@example.com")
+
+    tasks.sync_user_avatar_task(user.pk, "https://example.com/broken.png")
+    user.refresh_from_db()
+
+    assert not user.avatar
+    assert avatars.get_avatar_source(user)["rejected"] == "invalid image"
+
+
+@pytest.mark.django_db
+def test_sync_user_avatar_task_keeps_concurrent_metadata(monkeypatch):
+    user = User.objects.create(email="user@example.com")
+
+    def request(*args, **kwargs):
+        # written by another process while the avatar downloads
+        other = User.objects.get(pk=user.pk)
+        other.store_value_in_private_metadata({"other": "value"})
+        other.save(update_fields=["private_metadata"])
+        return image_response(make_png(8))
+
+    monkeypatch.setattr(avatars.http_client, "request", request)
+    tasks.sync_user_avatar_task(user.pk, "https://example.com/default.png")
+    user.refresh_from_db()
+
+    assert user.avatar
+    assert user.get_value_from_private_metadata("other") == "value"
+    assert avatars.get_avatar_source(user)["url"] == "https://example.com/default.png"
+
+
+@pytest.mark.django_db
+def test_identical_avatars_share_one_file(monkeypatch):
+    image = make_png(8)
+    monkeypatch.setattr(
+        avatars.http_client, "request", lambda *args, **kwargs: image_response(image)
+    )
+    first = User.objects.create(email="first@example.com")
+    second = User.objects.create(email="second@example.com")
+
+    for user in [first, second]:
+        tasks.sync_user_avatar_task(user.pk, "https://example.com/default.png")
+        user.refresh_from_db()
+
+    assert first.avatar.name == second.avatar.name
+    assert hashlib.sha256(image).hexdigest() in first.avatar.name
+
+    name, storage = first.avatar.name, first.avatar.storage
+    deletions = []
+    monkeypatch.setattr(
+        tasks.delete_unused_avatar_task,
+        "apply_async",
+        lambda kwargs, countdown: deletions.append(kwargs),
+    )
+    avatars.release_avatar(first)
+    first.save(update_fields=["avatar"])
+    avatars.delete_unused_avatar(**deletions.pop())
+    assert storage.exists(name)
+
+    avatars.release_avatar(second)
+    second.save(update_fields=["avatar"])
+    # shared again before the deletion ran
+    first.avatar.name = name
+    first.save(update_fields=["avatar"])
+    avatars.delete_unused_avatar(**deletions.pop())
+    assert storage.exists(name)
+
+    avatars.release_avatar(first)
+    first.save(update_fields=["avatar"])
+    avatars.delete_unused_avatar(**deletions.pop())
+    assert not storage.exists(name)
+
+
+def test_tasks_import_on_supported_saleor():
+    # Saleor 3.6+ makes thumbnails on demand in its thumbnail app
+    assert importlib.util.find_spec("saleor.thumbnail")
+    assert importlib.reload(tasks).sync_user_avatar_task
@@ -0,0 +1,68 @@
+import pytest
+
+from .. import breaker
+from ..external_auth_types import CircuitBreakerConfig, ProviderUnavailableError
+
+CONFIG = CircuitBreakerConfig(
+    window=10, min_calls=4, error_rate=0.5, slow_call_seconds=1, open_seconds=60
+)
+
+
+def test_breaker_opens_on_errors():
+    circuit_breaker = breaker.CircuitBreaker("facebook", CONFIG)
+    for succeeded in [True, False, True, False]:
+        circuit_breaker.before_call()
+        circuit_breaker.record(succeeded, 0.1)
+
+    assert circuit_breaker.state == breaker.OPEN
+    with pytest.raises(ProviderUnavailableError):
+        circuit_breaker.before_call()
+
+
+def test_breaker_opens_on_slow_calls():
+    circuit_breaker = breaker.CircuitBreaker("facebook", CONFIG)
+    for seconds in [0.1, 2, 0.1, 2]:
+        circuit_breaker.record(True, seconds)
+
+    assert circuit_breaker.state == breaker.OPEN
+
+
+def test_breaker_half_open_probe(monkeypatch):
+    circuit_breaker = breaker.CircuitBreaker("facebook", CONFIG)
+    for _ in range(4):
+        circuit_breaker.record(False, 0.1)
+    now = breaker.time.monotonic()
+    monkeypatch.setattr(breaker.time, "monotonic", lambda: now + 61)
+
+    circuit_breaker.before_call()
+    assert circuit_breaker.state == breaker.HALF_OPEN
+    # only one probe at a time
+    with pytest.raises(ProviderUnavailableError):
+        circuit_breaker.before_call()
+
+    circuit_breaker.record(True, 0.1)
+    assert circuit_breaker.state == breaker.CLOSED
+
+
+def test_breaker_half_open_probe_failure(monkeypatch):
+    circuit_breaker = breaker.CircuitBreaker("facebook", CONFIG)
+    for _ in range(4):
+        circuit_breaker.record(False, 0.1)
+    now = breaker.time.monotonic()
+    monkeypatch.setattr(breaker.time, "monotonic", lambda: now + 61)
+    circuit_breaker.before_call()
+
+    circuit_breaker.record(False, 0.1)
+    assert circuit_breaker.state == breaker.OPEN
+
+
+def test_adaptive_read_timeout():
+    circuit_breaker = breaker.CircuitBreaker(
+        "google", CircuitBreakerConfig(min_calls=4, min_timeout=0.5)
+    )
+    assert circuit_breaker.read_timeout(10) == 10
+
+    for _ in range(4):
+        circuit_breaker.record(True, 0.4)
+    assert circuit_breaker.read_timeout(10) == pytest.approx(1.2)
+    assert circuit_breaker.read_timeout(1) == 1
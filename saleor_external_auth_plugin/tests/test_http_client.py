@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from .. import http_client
+from ..external_auth_types import ExternalAuthError, HttpConfig, Uri
+from .fixtures import providers_dict
+
+
+def test_get_session_is_shared_by_name():
+    config = HttpConfig(pool_size=3)
+
+    assert http_client.get_session("google", config) is http_client.get_session(
+        "google", config
+    )
+
+
+def test_get_session_rebuilds_on_new_config():
+    session = http_client.get_session("facebook", HttpConfig(pool_size=3))
+
+    assert session is not http_client.get_session("facebook", HttpConfig(retries=0))
+
+
+def test_build_session_retries_only_idempotent_methods():
+    _, adapter = http_client.build_session(HttpConfig(retries=4, pool_size=7))
+
+    assert adapter.max_retries.total == 4
+    assert "POST" not in adapter.max_retries.allowed_methods
+    assert adapter._pool_maxsize == 7
+
+
+def test_timeout_from_uri():
+    config = HttpConfig(connect_timeout=1, read_timeout=5)
+
+    assert config.timeout() == (1, 5)
+    assert config.timeout(Uri(path="http://a", timeout=2)) == (1, 2)
+
+
+def test_request_counts_pool_usage(monkeypatch):
+    provider = providers_dict.get("google")
+
+    def mocked_send(adapter, request, **kwargs):
+        assert kwargs["timeout"] == provider.http.timeout()
+        response = http_client.requests.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(http_client.HTTPAdapter, "send", mocked_send)
+    http_client.request("GET", provider, "https://www.googleapis.com")
+
+    assert http_client.pool_stats()["google"].requests >= 1
+    assert http_client.pool_stats()["google"].in_flight == 0
+
+
+def test_timeout_cut_to_deadline():
+    config = HttpConfig(connect_timeout=3, read_timeout=10)
+
+    connect, read = http_client.timeout(config, None, None, time.monotonic() + 2)
+
+    assert connect <= 2 and read <= 2
+
+
+def test_timeout_after_deadline():
+    with pytest.raises(ExternalAuthError):
+        http_client.timeout(HttpConfig(), None, None, time.monotonic() - 1)
+
+
+@pytest.mark.parametrize("left, retries", [(None, 2), (100, 2), (30, 1), (5, 1)])
+def test_request_retries_within_deadline(monkeypatch, left, retries):
+    provider = providers_dict.get("google")
+    deadline = None if left is None else time.monotonic() + left
+    used, timeouts = [], []
+
+    def mocked_send(adapter, request, **kwargs):
+        used.append(adapter.max_retries.total)
+        timeouts.append(kwargs["timeout"])
+        response = http_client.requests.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(http_client.HTTPAdapter, "send", mocked_send)
+    http_client.request("GET", provider, "https://www.googleapis.com", None, deadline)
+
+    assert used == [retries]
+    if left:
+        # each attempt fits in the time left
+        assert sum(timeouts[0]) * (retries + 1) <= left
+    adapter = http_client.get_session("google", provider.http).get_adapter("https://")
+    assert adapter.max_retries.total == provider.http.retries
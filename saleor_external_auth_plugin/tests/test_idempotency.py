@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+
+from .. import idempotency
+from ..external_auth_types import Context, ExternalAuthError
+from ..state import MemoryStateStore
+from .fixtures import providers_dict
+
+CLIENT = "203.0.113.1"
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = MemoryStateStore(max_size=10)
+    monkeypatch.setattr(idempotency, "get_state_store", lambda: store)
+    return store
+
+
+def make_context(code="code", state="state"):
+    return Context(
+        payload={"code": code, "state": state}, provider=providers_dict["google"]
+    )
+
+
+def test_exchange_returns_issued_tokens(store):
+    calls = []
+
+    def tokens(context):
+        calls.append(context)
+        return object()
+
+    first = idempotency.exchange(make_context(), tokens, CLIENT)
+
+    assert idempotency.exchange(make_context(), tokens, CLIENT) is first
+    assert idempotency.exchange(make_context("other"), tokens, CLIENT) is not first
+    assert len(calls) == 2
+
+
+def test_exchange_returns_issued_tokens_to_their_client_only(store):
+    calls = []
+
+    def tokens(context):
+        calls.append(context)
+        return object()
+
+    first = idempotency.exchange(make_context(), tokens, CLIENT)
+
+    assert idempotency.exchange(make_context(), tokens, "198.51.100.7") is not first
+    assert idempotency.exchange(make_context(), tokens, None) is not first
+    assert len(calls) == 3
+
+
+def test_exchange_of_unknown_client_is_not_kept(store):
+    idempotency.exchange(make_context(), lambda context: object(), None)
+
+    assert store.get(idempotency.exchange_key(make_context(), None)) is None
+
+
+def test_exchange_with_other_state_runs_the_pipeline(store):
+    def tokens(context):
+        if context.payload["state"] != "state":
+            raise ExternalAuthError("Invalid request state", "invalid_state")
+        return object()
+
+    idempotency.exchange(make_context(), tokens, CLIENT)
+
+    with pytest.raises(ExternalAuthError):
+        idempotency.exchange(make_context(state="forged"), tokens, CLIENT)
+
+
+def test_exchange_does_not_keep_errors(store):
+    def tokens(context):
+        raise ExternalAuthError("invalid_grant", "provider_error")
+
+    for _ in range(2):
+        with pytest.raises(ExternalAuthError):
+            idempotency.exchange(make_context(), tokens, CLIENT)
+
+    assert store.get(idempotency.exchange_key(make_context(), CLIENT)) is None
+
+
+def test_concurrent_exchanges_share_one_call(store):
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def tokens(context):
+        calls.append(context)
+        started.set()
+        release.wait(5)
+        return object()
+
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                idempotency.exchange(make_context(), tokens, CLIENT)
+            )
+        )
+        for _ in range(4)
+    ]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert len(results) == 4 and len(set(map(id, results))) == 1
@@ -0,0 +1,21 @@
+from ..benchmarks import import_time
+
+
+def test_slowest_imports_only_counts_plugin_import():
+    stderr = "\n".join(
+        [
+            "import time: self [us] | cumulative | imported package",
+            "import time:      900 |        900 | django.setup_module",
+            import_time.START,
+            "import time:       50 |         50 |   yaml.reader",
+            "import time:      300 |        350 | yaml",
+            "import time:       20 |        370 | saleor_external_auth_plugin.plugin",
+            import_time.END,
+            "import time:     1000 |       1000 | warm_up_module",
+        ]
+    )
+
+    assert import_time.slowest_imports(stderr, 2) == [
+        {"module": "yaml", "self_ms": 0.3, "cumulative_ms": 0.35},
+        {"module": "yaml.reader", "self_ms": 0.05, "cumulative_ms": 0.05},
+    ]
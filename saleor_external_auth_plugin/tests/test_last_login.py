@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
+
+from .. import last_login
+from ..last_login import CacheLastLoginBuffer, LastLoginBuffer, MemoryLastLoginBuffer
+from .fixtures import user
+
+now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def written(monkeypatch):
+    written = []
+    monkeypatch.setattr(LastLoginBuffer, "start_timer", lambda self: None)
+    monkeypatch.setattr(
+        last_login, "write", lambda last_logins, batch_size: written.append(last_logins)
+    )
+    return written
+
+
+def cache_buffer(flush_size=10):
+    buffer = CacheLastLoginBuffer("default", flush_size, max_staleness=3600)
+    buffer.cache = LocMemCache("last-login-test", {})
+    buffer.cache.clear()
+    return buffer
+
+
+def test_memory_buffer_keeps_latest_login_per_user(written):
+    buffer = MemoryLastLoginBuffer(flush_size=10, max_staleness=3600)
+
+    buffer.add(1, now)
+    buffer.add(1, now + timedelta(seconds=1))
+    buffer.add(2, now)
+
+    assert written == [] and buffer.pending() == 2
+    buffer.flush()
+    assert written == [{1: now + timedelta(seconds=1), 2: now}]
+    assert buffer.pending() == 0
+
+
+def test_memory_buffer_wakes_timer_when_full(written):
+    buffer = MemoryLastLoginBuffer(flush_size=2, max_staleness=3600)
+
+    buffer.add(1, now)
+    assert not buffer._wake.is_set()
+    buffer.add(2, now)
+
+    # not written by the login itself
+    assert written == [] and buffer._wake.is_set()
+
+
+def test_memory_buffer_wakes_timer_when_stale(monkeypatch, written):
+    clock = [100.0]
+    monkeypatch.setattr(last_login.time, "monotonic", lambda: clock[0])
+    buffer = MemoryLastLoginBuffer(flush_size=10, max_staleness=3600)
+
+    buffer.add(1, now)
+    clock[0] += 3600
+    buffer.add(2, now)
+
+    assert buffer._wake.is_set()
+
+
+def test_memory_buffer_keeps_logins_of_failed_write(monkeypatch, written):
+    def write(last_logins, batch_size):
+        raise RuntimeError("database is down")
+
+    buffer = MemoryLastLoginBuffer(flush_size=10, max_staleness=3600)
+    buffer.add(1, now)
+    with monkeypatch.context() as failing:
+        failing.setattr(last_login, "write", write)
+        with pytest.raises(RuntimeError):
+            buffer.flush()
+
+    buffer.flush()
+    assert written == [{1: now}]
+
+
+def test_cache_buffer(written):
+    buffer = cache_buffer(flush_size=3)
+
+    buffer.add(1, now)
+    buffer.add(1, now + timedelta(seconds=1))
+    assert not buffer._wake.is_set()
+    buffer.add(2, now)
+    assert buffer._wake.is_set()
+
+    buffer.flush()
+    buffer.flush()
+    assert written == [{1: now + timedelta(seconds=1), 2: now}, {}]
+
+
+def test_cache_buffer_numbers_after_flushed_when_seq_evicted(written):
+    buffer = cache_buffer()
+    buffer.add(1, now)
+    buffer.flush()
+    buffer.cache.delete(buffer.key("seq"))
+
+    buffer.add(2, now)
+    buffer.flush()
+
+    assert written == [{1: now}, {2: now}]
+
+
+@pytest.mark.django_db
+def test_write(user, django_assert_num_queries):
+    user.save()
+
+    with django_assert_num_queries(1):
+        last_login.write({user.pk: now}, batch_size=10)
+
+    user.refresh_from_db()
+    assert user.last_login == now
+
+
+@pytest.mark.django_db(transaction=True)
+def test_flush_in_background_after_connection_closed(monkeypatch, user):
+    monkeypatch.setattr(LastLoginBuffer, "start_timer", lambda self: None)
+    user.save()
+    buffer = MemoryLastLoginBuffer(flush_size=10, max_staleness=3600)
+    buffer.add(user.pk, now)
+    connection.close()
+
+    buffer.flush_in_background()
+
+    user.refresh_from_db()
+    assert user.last_login == now and buffer.pending() == 0
@@ -0,0 +1,71 @@
+import pytest
+
+from .. import metrics
+from ..external_auth_types import ExternalAuthError
+from .fixtures import context
+
+
+class RecordingSink(metrics.MetricsSink):
+    def __init__(self):
+        self.timings = []
+        self.increments = []
+
+    def timing(self, name, seconds, tags):
+        self.timings.append((name, tags))
+
+    def increment(self, name, tags):
+        self.increments.append((name, tags))
+
+
+@pytest.fixture
+def sink():
+    sink = RecordingSink()
+    metrics.set_sink(sink)
+    yield sink
+    metrics.set_sink(None)
+
+
+def first_stage(context):
+    return context
+
+
+def failing_stage(context):
+    raise ExternalAuthError("Invalid request state", "invalid_state")
+
+
+def test_instrument_records_stages(sink, context):
+    assert metrics.instrument("tokens", [first_stage, first_stage])(context) is context
+
+    assert (
+        sink.timings
+        == [
+            (
+                metrics.STAGE_SECONDS,
+                {"pipeline": "tokens", "stage": "first_stage", "provider": "google"},
+            )
+        ]
+        * 2
+    )
+
+
+def test_instrument_records_errors_by_cause(sink, context):
+    with pytest.raises(ExternalAuthError):
+        metrics.instrument("tokens", [first_stage, failing_stage])(context)
+
+    assert sink.increments == [
+        (
+            metrics.STAGE_ERRORS,
+            {
+                "pipeline": "tokens",
+                "stage": "failing_stage",
+                "provider": "google",
+                "cause": "invalid_state",
+            },
+        )
+    ]
+
+
+def test_instrument_without_sink(context):
+    metrics.set_sink(None)
+
+    assert metrics.instrument("tokens", [first_stage])(context) is context
@@ -0,0 +1,26 @@
+from .. import utils as u
+from ..benchmarks import micro
+
+
+def test_synthetic_user_info_nests_avatar_url():
+    assert (
+        u.dict_str_lookup("http")(micro.synthetic_user_info(16))
+        == "https://cdn.com/pic.jpg"
+    )
+
+
+def test_regressions_beyond_thresholds():
+    baseline = {
+        "pipe": {"us_per_call": 10.0, "peak_bytes": 1000, "blocks": 10},
+        "make_uri": {"us_per_call": 10.0, "peak_bytes": 1000, "blocks": 10},
+    }
+    results = {
+        "pipe": {"us_per_call": 12.0, "peak_bytes": 1200, "blocks": 10},
+        "make_uri": {"us_per_call": 13.0, "peak_bytes": 1000, "blocks": 10},
+        "new": {"us_per_call": 1.0, "peak_bytes": 1, "blocks": 1},
+    }
+
+    assert micro.regressions(results, baseline, 0.25, 0.1) == [
+        "pipe: peak_bytes 1200 > 1000 +10%",
+        "make_uri: us_per_call 13.0 > 10.0 +25%",
+    ]
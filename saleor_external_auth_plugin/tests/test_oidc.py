@@ -0,0 +1,101 @@
+import time
+from dataclasses import replace
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .. import oidc
+from ..external_auth_types import ExternalAuthError, OidcConfig
+from .fixtures import providers_dict
+
+DISCOVERY_URI = "https://accounts.google.com/.well-known/openid-configuration"
+JWKS_URI = "https://www.googleapis.com/oauth2/v3/certs"
+ISSUER = "https://accounts.google.com"
+
+
+@pytest.fixture
+def provider():
+    oidc.clear_cache()
+    return replace(
+        providers_dict.get("google"), oidc=OidcConfig(discovery_uri=DISCOVERY_URI)
+    )
+
+
+@pytest.fixture
+def private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def provider_documents(monkeypatch, private_key):
+    jwk = jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    documents = {
+        DISCOVERY_URI: {"issuer": ISSUER, "jwks_uri": JWKS_URI},
+        JWKS_URI: {"keys": [{**jwk, "kid": "key-1", "alg": "RS256", "use": "sig"}]},
+    }
+    calls = []
+
+    def mocked_fetch_json(provider, uri):
+        calls.append(uri)
+        return documents[uri]
+
+    monkeypatch.setattr(oidc, "fetch_json", mocked_fetch_json)
+    return calls
+
+
+def make_id_token(private_key, kid="key-1", **claims):
+    claims = {
+        "iss": "accounts.google.com",
+        "aud": "your google id",
+        "exp": int(time.time()) + 300,
+        "iat": int(time.time()),
+        "sub": "1234",
+        "email": "john@doe.com",
+        "given_name": "John",
+        "family_name": "Doe",
+        **claims,
+    }
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+def test_get_user_info_from_id_token(provider, private_key, provider_documents):
+    user_info = oidc.get_user_info(provider, make_id_token(private_key), None)
+
+    assert user_info == {
+        "sub": "1234",
+        "email": "john@doe.com",
+        "given_name": "John",
+        "family_name": "Doe",
+    }
+
+
+def test_documents_are_cached(provider, private_key, provider_documents):
+    oidc.get_user_info(provider, make_id_token(private_key), None)
+    oidc.get_user_info(provider, make_id_token(private_key), None)
+
+    assert provider_documents == [DISCOVERY_URI, JWKS_URI]
+
+
+def test_get_user_info_with_wrong_audience(provider, private_key, provider_documents):
+    with pytest.raises(ExternalAuthError):
+        oidc.get_user_info(
+            provider, make_id_token(private_key, aud="someone else"), None
+        )
+
+
+def test_get_user_info_with_nonce(provider, private_key, provider_documents):
+    id_token = make_id_token(private_key, nonce="abc")
+
+    assert oidc.get_user_info(provider, id_token, "abc")["email"] == "john@doe.com"
+    with pytest.raises(ExternalAuthError):
+        oidc.get_user_info(provider, id_token, "replayed")
+
+
+def test_get_user_info_with_unknown_key(provider, private_key, provider_documents):
+    oidc.get_user_info(provider, make_id_token(private_key), None)
+    with pytest.raises(ExternalAuthError):
+        oidc.get_user_info(provider, make_id_token(private_key, kid="key-2"), None)
+
+    # keys are not refetched more often than MIN_JWKS_REFRESH_INTERVAL
+    assert provider_documents.count(JWKS_URI) == 1
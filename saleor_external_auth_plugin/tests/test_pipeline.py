@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from .. import pipeline
+from ..external_auth_types import Context, ExternalAuthError
+from .fixtures import providers_dict
+
+
+def make_context(deadline=None):
+    return Context(payload={}, provider=providers_dict["google"], deadline=deadline)
+
+
+def add(name):
+    def stage(context):
+        return context.with_data(**{name: True})
+
+    return stage
+
+
+def test_budget_pipe_sets_deadline(settings):
+    settings.EXTERNAL_AUTH_LOGIN_BUDGET = 5
+
+    context = pipeline.budget_pipe(add("first"))(make_context())
+
+    assert 4 < context.remaining() <= 5 and context.data == {"first": True}
+
+
+def test_budget_pipe_without_budget(settings):
+    settings.EXTERNAL_AUTH_LOGIN_BUDGET = None
+
+    assert pipeline.budget_pipe(add("first"))(make_context()).deadline is None
+
+
+def test_budget_pipe_skips_optional_stages(settings):
+    settings.EXTERNAL_AUTH_OPTIONAL_STAGE_MIN_BUDGET = 1
+    run = pipeline.budget_pipe(add("first"), pipeline.optional(add("avatar")))
+
+    assert run(make_context(time.monotonic() + 0.5)).data == {"first": True}
+    assert run(make_context(time.monotonic() + 5)).data == {
+        "first": True,
+        "avatar": True,
+    }
+
+
+def test_budget_pipe_after_deadline():
+    with pytest.raises(ExternalAuthError) as error:
+        pipeline.budget_pipe(add("first"))(make_context(time.monotonic() - 1))
+
+    assert error.value.cause == "deadline_exceeded"
+
+
+def test_budget_pipe_reports_failures_after_deadline():
+    def slow_failure(context):
+        time.sleep(0.02)
+        raise ExternalAuthError("timeout", "credentials_unavailable")
+
+    with pytest.raises(ExternalAuthError) as error:
+        pipeline.budget_pipe(slow_failure)(make_context(time.monotonic() + 0.01))
+
+    assert error.value.cause == "deadline_exceeded"
@@ -0,0 +1,18 @@
+import sys
+
+from .. import plugin
+
+LOGIN_MODULES = ("external_auth", "idempotency", "profiling", "ratelimit")
+
+
+def test_warm_up_imports_login_modules(monkeypatch):
+    package = sys.modules[plugin.__package__]
+    for name in LOGIN_MODULES:
+        monkeypatch.delitem(sys.modules, f"{package.__name__}.{name}")
+        # the modules other tests use are put back afterwards
+        monkeypatch.setattr(package, name, getattr(package, name))
+
+    plugin.warm_up()
+
+    for name in LOGIN_MODULES:
+        assert f"{package.__name__}.{name}" in sys.modules
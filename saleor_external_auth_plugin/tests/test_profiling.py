@@ -0,0 +1,65 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from .. import profiling
+
+
+def first_stage(context):
+    return [*context, "first"]
+
+
+def second_stage(context):
+    return [*context, "second"]
+
+
+def run_stages(context):
+    return second_stage(first_stage(context))
+
+
+def test_profiler_writes_login_files(tmp_path):
+    profiler = profiling.Profiler(1, str(tmp_path), max_logins=10)
+    run = profiler.wrap("tokens", run_stages, [first_stage, second_stage])
+
+    assert run([]) == ["first", "second"]
+
+    files = sorted(os.listdir(tmp_path))
+    assert [f.rsplit(".", 1)[1] for f in files] == ["json", "prof", "tracemalloc"]
+    with open(tmp_path / files[0]) as file:
+        summary = json.load(file)
+    assert set(summary["stages"]) == {"first_stage", "second_stage"}
+    assert summary["stages"]["first_stage"]["calls"] == 1
+
+
+def test_profiler_keeps_last_logins(tmp_path):
+    profiler = profiling.Profiler(1, str(tmp_path), max_logins=2)
+    run = profiler.wrap("tokens", run_stages, [first_stage, second_stage])
+    for _ in range(4):
+        run([])
+
+    assert len(os.listdir(tmp_path)) == 2 * 3
+
+
+def test_profiler_keeps_last_logins_of_dotted_provider(tmp_path):
+    profiler = profiling.Profiler(1, str(tmp_path), max_logins=2)
+    context = SimpleNamespace(provider=SimpleNamespace(name="my-idp.example/v2"))
+    run = profiler.wrap("tokens", lambda context: context, [])
+    for _ in range(4):
+        run(context)
+
+    files = os.listdir(tmp_path)
+    assert len(files) == 2 * 3
+    assert all("my-idp.example_v2" in name for name in files)
+
+
+@pytest.mark.parametrize("rate", ["often", "2", "-0.5"])
+def test_get_profiler_with_invalid_rate(monkeypatch, caplog, rate):
+    monkeypatch.setenv("EXTERNAL_AUTH_PROFILE_RATE", rate)
+    profiling.get_profiler.cache_clear()
+
+    assert profiling.get_profiler() is None
+    assert profiling.get_profiler() is None
+    assert len(caplog.records) == 1
+    profiling.get_profiler.cache_clear()
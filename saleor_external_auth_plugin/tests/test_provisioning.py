@@ -0,0 +1,117 @@
+import dataclasses
+import io
+
+import pytest
+from saleor.account.models import User
+
+from .. import external_auth as ea
+from .. import provisioning, tasks
+from ..models import ExternalIdentity
+from .fixtures import context_with_credentials, context_with_user_info, userinfo
+
+
+def test_read_records_jsonl():
+    file = io.StringIO('{"email": "a@example.com"}\n\n{"email": "b@example.com"}\n')
+
+    assert [r["email"] for r in provisioning.read_records(file, "jsonl")] == [
+        "a@example.com",
+        "b@example.com",
+    ]
+
+
+def test_read_records_csv():
+    file = io.StringIO("email,given_name\na@example.com,Ann\n")
+
+    assert list(provisioning.read_records(file, "csv")) == [
+        {"email": "a@example.com", "given_name": "Ann"}
+    ]
+
+
+def test_batches():
+    assert [len(b) for b in provisioning.batches(range(5), 2)] == [2, 2, 1]
+
+
+@pytest.mark.django_db
+def test_provision(monkeypatch):
+    queued = []
+    monkeypatch.setattr(
+        tasks.sync_user_avatar_task,
+        "apply_async",
+        lambda kwargs, countdown: queued.append((kwargs, countdown)),
+    )
+    User.objects.create(email="old@example.com", first_name="Old")
+    records = [
+        {"email": "old@example.com", "given_name": "New"},
+        {
+            "email": "new@example.com",
+            "sub": "1234",
+            "picture": "https://example.com/a.png",
+        },
+        {"email": "", "given_name": "Nobody"},
+    ]
+
+    stats = list(provisioning.provision("Google", records, 2, avatars_per_second=10))[
+        -1
+    ]
+
+    assert (stats.read, stats.created, stats.updated, stats.skipped) == (3, 1, 1, 1)
+    assert stats.linked == 1
+    assert User.objects.get(email="old@example.com").first_name == "New"
+    new = User.objects.get(email="new@example.com")
+    assert ExternalIdentity.objects.get(provider="google", subject="1234").user == new
+    assert queued == [
+        ({"user_id": new.pk, "avatar_uri": "https://example.com/a.png"}, 0)
+    ]
+
+
+@pytest.mark.django_db
+def test_first_login_of_provisioned_user_only_updates_it(
+    monkeypatch, context_with_user_info, django_assert_num_queries
+):
+    monkeypatch.setattr(tasks.sync_user_avatar_task, "delay", lambda **kwargs: None)
+    user_info = {**context_with_user_info.data["user_info"], "sub": "1234"}
+    list(provisioning.provision("google", [user_info]))
+    login = context_with_user_info.with_data(user_info=user_info)
+
+    # the user and its identity in one query, then the last_login update
+    with django_assert_num_queries(2):
+        ea.update_user(ea.get_user(login))
+
+
+@pytest.mark.django_db
+def test_provision_counts_inserted_users_only(monkeypatch):
+    monkeypatch.setattr(tasks.sync_user_avatar_task, "apply_async", lambda **kw: None)
+    bulk_create = User.objects.bulk_create
+
+    def create_with_login_meanwhile(users, **kwargs):
+        User.objects.create(email=users[0].email)
+        return bulk_create(users, **kwargs)
+
+    monkeypatch.setattr(User.objects, "bulk_create", create_with_login_meanwhile)
+    records = [{"email": "a@example.com"}, {"email": "b@example.com"}]
+
+    stats = list(provisioning.provision("google", records))[-1]
+
+    assert stats.created == 1
+    assert (
+        User.objects.filter(email__in=["a@example.com", "b@example.com"]).count() == 2
+    )
+
+
+@pytest.mark.django_db
+def test_login_finds_identity_provisioned_with_other_case(
+    monkeypatch, context_with_user_info
+):
+    monkeypatch.setattr(tasks.sync_user_avatar_task, "apply_async", lambda **kw: None)
+    user_info = {**context_with_user_info.data["user_info"], "sub": "1234"}
+    list(provisioning.provision(" Google", [user_info]))
+    provider = dataclasses.replace(context_with_user_info.provider, name="GOOGLE")
+    # the email changed at the provider since the export
+    login = dataclasses.replace(context_with_user_info, provider=provider).with_data(
+        user_info={**user_info, "email": "changed@example.com"}
+    )
+
+    user = ea.get_user(login).data["user"]
+
+    assert user.pk and user.email == context_with_user_info.data["user_info"]["email"]
+    assert ea.get_user(login).data["subject"] is None
@@ -0,0 +1,110 @@
+import pytest
+
+from .. import external_auth as ea
+from .. import ratelimit
+from ..external_auth_types import ExternalAuthError, RateLimitedError
+from ..ratelimit import MemoryBuckets, RateLimiter
+from .fixtures import context
+
+payload = {"provider": "google", "code": "code", "state": "state"}
+
+
+def test_memory_buckets_empty_after_burst():
+    buckets = MemoryBuckets(max_size=10)
+
+    assert [buckets.take("a", 0, 2) for _ in range(3)] == [True, True, False]
+    assert buckets.take("b", 0, 2)
+
+
+def test_memory_buckets_refill(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    buckets = MemoryBuckets(max_size=10)
+
+    assert buckets.take("a", 2, 1)
+    assert not buckets.take("a", 2, 1)
+    now[0] += 0.5
+    assert buckets.take("a", 2, 1)
+
+
+def test_memory_buckets_drop_least_recently_used():
+    buckets = MemoryBuckets(max_size=1)
+    buckets.take("a", 0, 1)
+    buckets.take("b", 0, 1)
+
+    assert buckets.take("a", 0, 1)
+
+
+def test_rate_limiter_client(settings):
+    settings.EXTERNAL_AUTH_RATE_LIMIT_IP_RATE = 0
+    settings.EXTERNAL_AUTH_RATE_LIMIT_IP_BURST = 1
+    limiter = RateLimiter(MemoryBuckets(max_size=10), rejected_size=10)
+    limiter.check_client("10.0.0.1")
+
+    with pytest.raises(RateLimitedError):
+        limiter.check_client("10.0.0.1")
+    limiter.check_client("10.0.0.2")
+
+
+@pytest.mark.parametrize(
+    "invalid",
+    [{}, {"code": ""}, {"code": None}, {"state": "x" * 1000}, {"provider": 1}],
+)
+def test_rate_limiter_malformed_payload(invalid):
+    limiter = RateLimiter(None, rejected_size=10)
+
+    with pytest.raises(ExternalAuthError) as error:
+        limiter.check_payload({**payload, **invalid})
+    assert error.value.cause == "invalid_payload"
+
+
+def test_rate_limiter_remembers_rejected_payload():
+    limiter = RateLimiter(None, rejected_size=10)
+    limiter.check_payload(payload)
+    limiter.remember(
+        payload, ExternalAuthError("Invalid request state", "invalid_state")
+    )
+
+    with pytest.raises(ExternalAuthError) as error:
+        limiter.check_payload(payload)
+    assert error.value.cause == "invalid_state"
+
+
+def test_rate_limiter_forgets_transient_errors():
+    limiter = RateLimiter(None, rejected_size=10)
+    limiter.remember(payload, ExternalAuthError("timeout", "credentials_unavailable"))
+
+    limiter.check_payload(payload)
+
+
+@pytest.mark.parametrize(
+    "proxies, forwarded, ip",
+    [
+        (0, "1.1.1.1", "10.0.0.1"),
+        (1, "1.1.1.1", "1.1.1.1"),
+        (1, "6.6.6.6, 1.1.1.1", "1.1.1.1"),
+        (2, "6.6.6.6, 1.1.1.1, 10.0.0.2", "1.1.1.1"),
+        (3, "1.1.1.1", "1.1.1.1"),
+        (1, None, "10.0.0.1"),
+    ],
+)
+def test_client_ip_behind_trusted_proxies(settings, rf, proxies, forwarded, ip):
+    settings.EXTERNAL_AUTH_RATE_LIMIT_TRUSTED_PROXIES = proxies
+    headers = {"HTTP_X_FORWARDED_FOR": forwarded} if forwarded else {}
+    request = rf.post("/graphql/", REMOTE_ADDR="10.0.0.1", **headers)
+
+    assert ratelimit.client_ip(request) == ip
+
+
+def test_invalid_state_takes_no_provider_token(monkeypatch, settings, context):
+    settings.EXTERNAL_AUTH_RATE_LIMIT_PROVIDER_RATE = 0
+    settings.EXTERNAL_AUTH_RATE_LIMIT_PROVIDER_BURST = 1
+    limiter = RateLimiter(MemoryBuckets(max_size=10), rejected_size=10)
+    monkeypatch.setattr(ratelimit, "_limiter", limiter)
+    context.payload["state"] = "forged"
+
+    for _ in range(2):
+        with pytest.raises(ExternalAuthError) as error:
+            ea.tokens(context)
+        assert error.value.cause == "invalid_state"
+    limiter.check_provider(context.provider.name)
@@ -0,0 +1,41 @@
+from ..state import MemoryStateStore
+
+
+def test_memory_store_pop():
+    store = MemoryStateStore(max_size=10)
+    store.put("state", {"provider": "google"}, ttl=60)
+
+    assert store.pop("state") == {"provider": "google"}
+    assert store.pop("state") is None
+
+
+def test_memory_store_expired():
+    store = MemoryStateStore(max_size=10)
+    store.put("state", {"provider": "google"}, ttl=-1)
+
+    assert store.pop("state") is None
+
+
+def test_memory_store_drops_oldest_when_full():
+    store = MemoryStateStore(max_size=2)
+    for state in ["a", "b", "c"]:
+        store.put(state, {}, ttl=60)
+
+    assert store.pop("a") is None
+    assert store.pop("b") == {} and store.pop("c") == {}
+
+
+def test_memory_store_get_does_not_consume():
+    store = MemoryStateStore(max_size=10)
+    store.put("state", {"provider": "google"}, ttl=60)
+
+    assert store.get("state") == store.get("state") == {"provider": "google"}
+    assert store.pop("state") == {"provider": "google"}
+
+
+def test_memory_store_put_many():
+    store = MemoryStateStore(max_size=10)
+    store.put_many({"a": {"provider": "google"}, "b": {"provider": "facebook"}}, 60)
+
+    assert store.pop("a") == {"provider": "google"}
+    assert store.pop("b") == {"provider": "facebook"}
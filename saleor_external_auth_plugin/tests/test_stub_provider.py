@@ -0,0 +1,30 @@
+import json
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from ..benchmarks.stub_provider import StubProvider, StubSettings
+
+
+def test_stub_provider_login_flow():
+    with StubProvider(StubSettings(payload_size=10)) as stub:
+        token = json.load(urlopen(f"{stub.url}/token", data=b"code=bench-1.7"))
+        request = Request(
+            f"{stub.url}/userinfo",
+            headers={"Authorization": f"Bearer {token['access_token']}"},
+        )
+        user_info = json.load(urlopen(request))
+        avatar = urlopen(user_info["picture"])
+
+        assert user_info["email"] == "bench-1@example.com"
+        assert user_info["padding"] == "x" * 10
+        assert avatar.headers["Content-Type"] == "image/png"
+        assert avatar.read().startswith(b"\x89PNG")
+        assert stub.server.requests == {"/token": 1, "/userinfo": 1, "/avatar.png": 1}
+
+
+def test_stub_provider_errors():
+    with StubProvider(StubSettings(error_rate=1)) as stub:
+        with pytest.raises(HTTPError):
+            urlopen(f"{stub.url}/userinfo")
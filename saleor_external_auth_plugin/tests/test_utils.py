@@ -0,0 +1,93 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+import pytest
+
+from .. import utils as u
+
+
+@dataclass
+class Inner:
+    path: str
+    params: dict = field(default_factory=dict)
+
+
+@dataclass
+class Outer:
+    name: str
+    inner: Inner
+    other: Optional[Inner] = None
+
+
+def test_dict_keys_to_lower():
+    assert u.dict_keys_to_lower({"A": 1, "B": {"C": {"D": 2}, "E": [3]}}) == {
+        "a": 1,
+        "b": {"c": {"d": 2}, "e": [3]},
+    }
+
+
+@pytest.mark.parametrize("input", [None, "text", ["A"]])
+def test_dict_keys_to_lower_with_non_dict(input):
+    with pytest.raises(TypeError):
+        u.dict_keys_to_lower(input)
+
+
+def test_instantiate():
+    value = {"a": {"path": "x"}, "b": {"c": {"path": "y", "params": {"k": "v"}}}}
+
+    assert u.instantiate(Inner)(value) == {
+        "a": Inner(path="x"),
+        "b": {"c": Inner(path="y", params={"k": "v"})},
+    }
+
+
+def test_instantiate_keeps_values_not_matching():
+    value = {"a": {"path": "x", "unknown": 1}, "b": {"params": {}}, "c": 1}
+
+    assert u.instantiate(Inner)(value) == value
+
+
+def test_load():
+    value = {"name": "n", "inner": {"path": "x"}, "other": {"path": "y"}}
+
+    assert u.load(Outer)(value) == Outer(
+        name="n", inner=Inner(path="x"), other=Inner(path="y")
+    )
+
+
+def test_load_with_none_nested():
+    value = {"name": "n", "inner": {"path": "x"}, "other": None}
+
+    assert u.load(Outer)(value) == Outer(name="n", inner=Inner(path="x"))
+
+
+@pytest.mark.parametrize(
+    "value, message",
+    [
+        ({"name": "n"}, "google: missing inner"),
+        ({"name": "n", "inner": {"path": "x", "foo": 1}}, "google.inner: unknown foo"),
+        ({"name": "n", "inner": "x"}, "google.inner should be a mapping"),
+    ],
+)
+def test_load_with_invalid_value(value, message):
+    with pytest.raises(TypeError, match=message):
+        u.load(Outer)(value, "google")
+
+
+def test_make_uri_encodes_params():
+    uri = u.make_uri("https://example.com/auth")
+    assert uri({}) == "https://example.com/auth"
+    assert (
+        uri({"redirect_uri": "http://localhost/a b", "scope": "openid email"})
+        == "https://example.com/auth?redirect_uri=http%3A%2F%2Flocalhost%2Fa+b&scope=openid+email"
+    )
+
+
+def test_add_query_extends_existing_query():
+    assert u.add_query("https://example.com/auth?a=1", {"b": "&"}) == (
+        "https://example.com/auth?a=1&b=%26"
+    )
+
+
+def test_lookup_name():
+    assert u.lookup_name(" Google ") == "google"
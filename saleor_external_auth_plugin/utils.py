@@ -1,7 +1,21 @@
-from functools import reduce
+from dataclasses import MISSING, fields, is_dataclass
+from functools import lru_cache, reduce
 from inspect import getmembers, ismodule
-from typing import Any, Callable, List, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    get_args,
+    get_origin,
+    get_type_hints,
+)
 from types import ModuleType
+from urllib.parse import urlencode
 
 NoneType = type(None)
 
@@ -13,17 +27,13 @@ def pipe(first: Any, *list: List[Callable[[Any], Any]]) -> Any:
 
 
 def dict_keys_to_lower(kmap: dict) -> dict:
-    return reduce(
-        lambda f, g: {**f, **g},
-        map(
-            lambda k: {
-                k.lower(): kmap[k]
-                if not isinstance(kmap[k], dict)
-                else dict_keys_to_lower(kmap[k])
-            },
-            kmap,
-        ),
-    )
+    if not isinstance(kmap, dict):
+        raise TypeError(f"Expected a dict, got {type(kmap).__name__}")
+
+    return {
+        k.lower(): dict_keys_to_lower(v) if isinstance(v, dict) else v
+        for k, v in kmap.items()
+    }
 
 
 def get_submodule(
@@ -50,40 +60,127 @@ def get_submodule(
     return get_module_by_name
 
 
+def add_query(uri: str, params: dict) -> str:
+    """'uri' with the url encoded 'params' appended to its query"""
+
+    if not params:
+        return uri
+    return f"{uri}{'&' if '?' in uri else '?'}{urlencode(params)}"
+
+
 def make_uri(path: str) -> Callable[[dict], str]:
     """Contrucs a URI through a initial 'path' and
     a dict of 'params' key value pairs"""
 
     def join_params(params: dict) -> str:
-        return (
-            f"{path}?" + "".join(f"{k}={v}&" for k, v in params.items())[:-1]
-            if params
-            else path
-        )
+        return add_query(path, params)
 
     return join_params
 
 
+def lookup_name(name: str) -> str:
+    """Normalized provider name used as configuration key"""
+
+    return name.strip().lower()
+
+
+@lru_cache(maxsize=None)
+def init_fields(type_class: type) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """(all, required) init argument names of the dataclass 'type_class'"""
+
+    init = [f for f in fields(type_class) if f.init]
+    return (
+        frozenset(f.name for f in init),
+        frozenset(
+            f.name
+            for f in init
+            if f.default is MISSING and f.default_factory is MISSING
+        ),
+    )
+
+
+def accepts_keys(type_class: type, value: dict) -> bool:
+    """If 'value' keys match the arguments of 'type_class', always
+    True for non dataclasses as their arguments are unknown"""
+
+    if not is_dataclass(type_class):
+        return True
+    names, required = init_fields(type_class)
+    return required <= value.keys() <= names
+
+
 def instantiate(type_class: type) -> Callable[[Union[dict, any]], Any]:
     """Try to instantiate 'type_class' in all possible values inside 'value'
     if it's a dict will recursively try to build 'type_class' in all nested values
     if can't instatiate 'type_class', then just returns 'value'"""
 
     def instantiate_type_class(value: Union[dict, any]) -> Any:
-        try:
-            return type_class(**value)
-        except:
-            if type(value) == dict:
-                return reduce(
-                    lambda acc, item: {**acc, item[0]: instantiate_type_class(item[1])},
-                    value.items(),
-                    {},
-                )
+        if type(value) != dict:
             return value
+        if accepts_keys(type_class, value):
+            try:
+                return type_class(**value)
+            except Exception:
+                pass
+        return {k: instantiate_type_class(v) for k, v in value.items()}
 
     return instantiate_type_class
 
 
+def dataclass_type(hint: Any) -> Optional[type]:
+    """The dataclass in a type hint like 'Uri' or 'Optional[Uri]'"""
+
+    if is_dataclass(hint):
+        return hint
+    if get_origin(hint) is Union:
+        return next(filter(is_dataclass, get_args(hint)), None)
+    return None
+
+
+@lru_cache(maxsize=None)
+def nested_dataclasses(type_class: type) -> Dict[str, type]:
+    hints = get_type_hints(type_class)
+    return {
+        name: dataclass_type(hints[name])
+        for name in init_fields(type_class)[0]
+        if dataclass_type(hints[name])
+    }
+
+
+def load(type_class: type) -> Callable[[dict], Any]:
+    """Build the dataclass 'type_class' from a dict in one pass, fields typed
+    as dataclasses are built from their nested dicts the same way.
+    Raises TypeError naming the offending keys when they don't match"""
+
+    def load_type_class(value: dict, path: str = "") -> Any:
+        if not isinstance(value, dict):
+            raise TypeError(f"{path or type_class.__name__} should be a mapping")
+
+        names, required = init_fields(type_class)
+        missing = sorted(required - value.keys())
+        unknown = sorted(value.keys() - names)
+        if missing or unknown:
+            raise TypeError(
+                f"{path or type_class.__name__}: "
+                + ", ".join(
+                    [f"missing {k}" for k in missing]
+                    + [f"unknown {k}" for k in unknown]
+                )
+            )
+
+        nested = nested_dataclasses(type_class)
+        return type_class(
+            **{
+                k: load(nested[k])(v, f"{path}.{k}" if path else k)
+                if k in nested and v is not None
+                else v
+                for k, v in value.items()
+            }
+        )
+
+    return load_type_class
+
+
 def dict_str_lookup(search: str) -> Callable[[dict], str]:
     """returns the first string containing 'search' from all fields in 'dict' including nested"""
 